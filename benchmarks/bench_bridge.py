@@ -0,0 +1,205 @@
+'''
+Bridge micro-benchmarks for wkwebview.
+
+Runs against the pure-Python stand-ins for objc_util, ui and console in
+the sim directory, so it can run anywhere, including a Linux CI box. WebKit
+is faked and answers immediately, so the numbers are the Python-side
+overhead of the bridge: JS evaluation and its completion handler, script
+message dispatch and the navigation delegate callbacks.
+
+To catch regressions, save the results of one commit and compare another
+one against them:
+
+    python benchmarks/bench_bridge.py --save baseline.json
+    python benchmarks/bench_bridge.py --compare baseline.json
+
+With --compare, exits with status 1 if any benchmark is slower than the
+baseline by more than --threshold percent.
+'''
+
+import argparse, gc, json, os, platform, sys, time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, 'sim'), os.path.dirname(here)]
+
+import objc_util, fake_webkit
+import wkwebview
+from wkwebview import WKWebView, NavigationRules
+
+
+class BenchWebView(WKWebView):
+
+    def on_event(self, message):
+        pass
+
+
+def make_view(**kwargs):
+    view = BenchWebView(**kwargs)
+    fake_webkit.navigate(view, 'https://example.com/')
+    return view
+
+
+def bench_eval_js(view):
+    return lambda: view.eval_js('document.title')
+
+
+def bench_eval_js_cached(view):
+    return lambda: view.eval_js('document.title', cache=True)
+
+
+def bench_eval_js_native(view):
+    native = make_view(value_format='native')
+    return lambda: native.eval_js('config')
+
+
+def bench_eval_js_async(view):
+    return lambda: view.eval_js_async('document.title', _ignore)
+
+
+def bench_eval_js_async_metrics(view):
+    measured = make_view(metrics=True)
+    return lambda: measured.eval_js_async('document.title', _ignore)
+
+
+def bench_handle_completion(view):
+    result = objc_util.ns('Example Domain')
+    token = wkwebview._retained.token()
+    return lambda: WKWebView._handle_completion(
+        _ignore, view, token, 'str', None, None, result.ptr, None)
+
+
+def bench_eval_js_many(view):
+    expressions = ['document.title'] * 10
+    return lambda: view.eval_js_many(expressions)
+
+
+def bench_message(view):
+    return lambda: fake_webkit.post_message(view, 'event', 'clicked')
+
+
+def bench_message_batch(view):
+    batch = json.dumps([['event', {'x': i, 'y': i}] for i in range(100)])
+    return lambda: fake_webkit.post_message(
+        view, WKWebView._batch_channel, batch)
+
+
+def bench_decide_policy(view):
+    return lambda: fake_webkit.decide_policy(view, 'https://example.com/a')
+
+
+def bench_decide_policy_rules(view):
+    ruled = make_view(navigation_rules=NavigationRules().
+        allow(hosts='example.com').deny(hosts=['ads.example.net']))
+    return lambda: fake_webkit.decide_policy(ruled, 'https://example.com/a')
+
+
+def bench_navigation(view):
+    return lambda: fake_webkit.navigate(view, 'https://example.com/b')
+
+
+def _ignore(result):
+    pass
+
+
+def _js_engine(webview, js):
+    if js == 'config':
+        return {'theme': 'dark', 'sizes': [1, 2, 3], 'debug': False}
+    if js.startswith('(function(){var r=[];'):
+        # eval_js_many batch
+        return json.dumps([[0, 'Example Domain']] * js.count('r.push([0,'))
+    return 'Example Domain'
+
+
+BENCHMARKS = [
+    ('eval_js', bench_eval_js),
+    ('eval_js cached', bench_eval_js_cached),
+    ('eval_js native', bench_eval_js_native),
+    ('eval_js_async', bench_eval_js_async),
+    ('eval_js_async metrics', bench_eval_js_async_metrics),
+    ('_handle_completion', bench_handle_completion),
+    ('eval_js_many x10', bench_eval_js_many),
+    ('message', bench_message),
+    ('message batch x100', bench_message_batch),
+    ('decide policy', bench_decide_policy),
+    ('decide policy rules', bench_decide_policy_rules),
+    ('navigation', bench_navigation),
+]
+
+
+def measure(func, number, repeat):
+    # Best of `repeat` runs, in microseconds per call. Like timeit, garbage
+    # collection is kept out of the measurement.
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            best = min(best, (time.perf_counter() - start) / number)
+        finally:
+            gc.enable()
+    return best * 1e6
+
+
+def run(number, repeat):
+    fake_webkit.set_js_engine(_js_engine)
+    view = make_view()
+    results = {}
+    for name, setup in BENCHMARKS:
+        func = setup(view)
+        func()
+        results[name] = measure(func, number, repeat)
+        print(f'{name:<24} {results[name]:10.2f} us')
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print()
+    print(f'{"":<24} {"baseline":>10} {"now":>10} {"change":>8}')
+    for name, now in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f'{name:<24} {"-":>10} {now:10.2f}')
+            continue
+        change = (now / before - 1) * 100
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<24} {before:10.2f} {now:10.2f} {change:+7.1f}%{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--number', type=int, default=2000,
+        help='calls per measurement')
+    parser.add_argument('--repeat', type=int, default=7,
+        help='measurements per benchmark, the best one is used')
+    parser.add_argument('--save', help='save the results as JSON')
+    parser.add_argument('--compare', help='compare with saved results')
+    parser.add_argument('--threshold', type=float, default=25.0,
+        help='slowdown in percent that counts as a regression')
+    args = parser.parse_args()
+
+    results = run(args.number, args.repeat)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'results': results,
+            }, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'\nSlower than baseline: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+'''
+Import time benchmark for wkwebview.
+
+Measures the time it takes to import the module, and separately the time
+the first WKWebView instantiation takes, as that is where the ObjC classes
+are now looked up and created. Run in Pythonista, from this directory.
+'''
+
+import importlib, os, statistics, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def time_import(rounds=20):
+    # Dependencies are imported up front so that only wkwebview itself
+    # is measured
+    import objc_util, ui, console
+    timings = []
+    for _ in range(rounds):
+        sys.modules.pop('wkwebview', None)
+        start = time.perf_counter()
+        importlib.import_module('wkwebview')
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def time_first_view():
+    sys.modules.pop('wkwebview', None)
+    wkwebview = importlib.import_module('wkwebview')
+    start = time.perf_counter()
+    wkwebview.WKWebView()
+    return time.perf_counter() - start
+
+
+def main():
+    timings = time_import()
+    print(f'import wkwebview: median {statistics.median(timings)*1000:.2f} ms, '
+        f'min {min(timings)*1000:.2f} ms ({len(timings)} rounds)')
+    print(f'first WKWebView(): {time_first_view()*1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
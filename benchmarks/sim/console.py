@@ -0,0 +1,15 @@
+'''
+Stand-in for Pythonista's console module, see objc_util.
+'''
+
+
+def alert(*args, **kwargs):
+    return 1
+
+
+def input_alert(*args, **kwargs):
+    return ''
+
+
+def set_color(*args):
+    pass
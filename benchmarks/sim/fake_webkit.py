@@ -0,0 +1,320 @@
+'''
+Fake WebKit for the objc_util stand-in.
+
+Javascript is not run. `evaluateJavaScript:completionHandler:` answers
+immediately with the value returned by the function given to
+`set_js_engine`. Navigations call the navigation delegate like WebKit
+would, either later from `objc_util.run_pending` for `load_url` and
+`load_html`, or immediately with `navigate`. Script messages are delivered
+with `post_message`.
+'''
+
+import json
+import objc_util
+from objc_util import (ObjCInstance, NSObj, NSString, NSURL, NativeBlock,
+    ns, _Class, pending, c_long)
+
+HANDLED_SCHEMES = {'http', 'https', 'file', 'about', 'data', 'blob'}
+
+# Urls that fail to load with a "host not found" error
+fail_urls = set()
+
+_js_engine = lambda webview, js: None
+
+
+def set_js_engine(engine):
+    ''' Sets the function called with the WebView and the javascript
+    source for every evaluation. It returns the Python value of the
+    result, or raises JavascriptException. '''
+    global _js_engine
+    _js_engine = engine
+
+
+class JavascriptException(Exception):
+    pass
+
+
+class UserContentController(ObjCInstance):
+
+    def __init__(self):
+        self.handlers = {}
+        self.scripts = []
+        self.rule_lists = []
+
+    def addScriptMessageHandler_name_(self, handler, name):
+        name = str(name)
+        if name in self.handlers:
+            raise RuntimeError('NSInvalidArgumentException: ' + name)
+        self.handlers[name] = handler
+
+    def removeScriptMessageHandlerForName_(self, name):
+        self.handlers.pop(str(name), None)
+
+    def removeAllScriptMessageHandlers(self):
+        self.handlers.clear()
+
+    def addUserScript_(self, script):
+        self.scripts.append(script)
+
+    def removeAllUserScripts(self):
+        self.scripts.clear()
+
+    def addContentRuleList_(self, rule_list):
+        self.rule_lists.append(rule_list)
+
+    def removeAllContentRuleLists(self):
+        self.rule_lists.clear()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+
+
+class UserScript(ObjCInstance):
+
+    def initWithSource_injectionTime_forMainFrameOnly_(self, source,
+            injection_time, main_frame_only):
+        self._source = str(source)
+        self._injection_time = injection_time
+        return self
+
+    def source(self):
+        return NSString(self._source)
+
+
+class Request(ObjCInstance):
+
+    def __init__(self, url=None):
+        self._url = url
+
+    def URL(self):
+        return self._url
+
+
+class Frame(ObjCInstance):
+
+    def __init__(self, url='about:blank', main=True):
+        self._request = Request(NSURL(url))
+        self._main = main
+
+    def request(self):
+        return self._request
+
+    def isMainFrame(self):
+        return self._main
+
+
+class NavigationAction(ObjCInstance):
+
+    def __init__(self, url, main=True):
+        self._request = Request(NSURL(url))
+        self._frame = Frame(url, main)
+
+    def request(self):
+        return self._request
+
+    def navigationType(self):
+        return -1
+
+    def targetFrame(self):
+        return self._frame
+
+
+class Error(ObjCInstance):
+
+    def __init__(self, code=-1, message='error'):
+        self._code = code
+        self._message = message
+
+    def code(self):
+        return self._code
+
+    def localizedDescription(self):
+        return NSString(self._message)
+
+
+class WebView(ObjCInstance):
+
+    def initWithFrame_configuration_(self, frame, configuration):
+        self._configuration = configuration
+        self._url = None
+        return self
+
+    def configuration(self):
+        return self._configuration
+
+    def URL(self):
+        return NSURL(self._url) if self._url else None
+
+    def evaluateJavaScript_completionHandler_(self, js, block):
+        try:
+            result, error = ns(_js_engine(self, str(js))), None
+        except JavascriptException as e:
+            result, error = None, Error(4, str(e))
+        if block is not None:
+            block(result, error)
+
+    def loadRequest_(self, request):
+        return self._load(str(request.URL()))
+
+    def loadHTMLString_baseURL_(self, html, base_url):
+        return self._load('about:blank')
+
+    def loadFileURL_allowingReadAccessToURL_(self, url, read_access_url):
+        return self._load(str(url))
+
+    def _load(self, url):
+        navigation = NSObj()
+        pending.append(lambda: self.navigate(url, navigation))
+        return navigation
+
+    def navigate(self, url, navigation=None, main=True):
+        ''' Runs a navigation through the delegate callbacks, and returns
+        the WKNavigation, or None if the delegate cancelled it. '''
+        navigation = navigation or NSObj()
+        if not decide_policy(self, url, main) or not main:
+            return None
+        delegate = self._props['navigationDelegate']
+        if url in fail_urls:
+            delegate.webView_didFailProvisionalNavigation_withError_(
+                self, navigation, Error(-1003, 'host not found'))
+            return navigation
+        self._url = url
+        delegate.webView_didCommitNavigation_(self, navigation)
+        delegate.webView_didFinishNavigation_(self, navigation)
+        return navigation
+
+    def takeSnapshotWithConfiguration_completionHandler_(self, configuration,
+            block):
+        image = NSObj()
+        pending.append(lambda: block(image, None))
+
+
+class Configuration(ObjCInstance):
+
+    def setURLSchemeHandler_forURLScheme_(self, handler, scheme):
+        self._props.setdefault('schemeHandlers', {})[str(scheme)] = handler
+
+
+class HTTPURLResponse(ObjCInstance):
+
+    def initWithURL_statusCode_HTTPVersion_headerFields_(self, url, status,
+            version, headers):
+        self.status = status
+        self.headers = headers
+        return self
+
+
+class ContentRuleListStore(ObjCInstance):
+
+    compiled = {}
+
+    def lookUpContentRuleListForIdentifier_completionHandler_(self,
+            identifier, block):
+        block(ContentRuleListStore.compiled.get(str(identifier)), None)
+
+    def compileContentRuleListForIdentifier_encodedContentRuleList_completionHandler_(
+            self, identifier, encoded, block):
+        try:
+            json.loads(str(encoded))
+        except ValueError:
+            block(None, Error(6, 'Rule list compilation failed'))
+            return
+        rule_list = NSObj()
+        ContentRuleListStore.compiled[str(identifier)] = rule_list
+        block(rule_list, None)
+
+
+class URLSchemeTask(ObjCInstance):
+
+    def __init__(self, url):
+        self._request = Request(NSURL(url))
+        self.events = []
+
+    def request(self):
+        return self._request
+
+    def didReceiveResponse_(self, response):
+        self.events.append(('response', response))
+
+    def didReceiveData_(self, data):
+        self.events.append(('data', data._data))
+
+    def didFinish(self):
+        self.events.append(('finish',))
+
+    def didFailWithError_(self, error):
+        self.events.append(('fail', error))
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+
+
+def objc_class(name):
+    if name == 'WKWebView':
+        return _Class(name, WebView, {
+            'handlesURLScheme_': lambda scheme:
+                str(scheme) in HANDLED_SCHEMES})
+    if name == 'NSURLRequest':
+        return _Class(name, NSObj, {
+            'requestWithURL_cachePolicy_timeoutInterval_':
+                lambda url, policy, timeout: Request(url)})
+    if name == 'WKContentRuleListStore':
+        return _Class(name, NSObj, {'defaultStore': ContentRuleListStore})
+    if name == 'NSData':
+        return _Class(name, objc_util.NSData, {
+            'dataWithBytes_length_': lambda data, length:
+                objc_util.NSData(data[:length])})
+    instance_types = {
+        'WKUserContentController': UserContentController,
+        'WKUserScript': UserScript,
+        'WKWebViewConfiguration': Configuration,
+        'NSHTTPURLResponse': HTTPURLResponse,
+        'NSString': objc_util.NSString,
+        'NSNumber': objc_util.NSNumber,
+        'NSArray': objc_util.NSArray,
+        'NSDictionary': objc_util.NSDictionary,
+        'NSNull': objc_util.NSNull,
+    }
+    return _Class(name, instance_types.get(name, NSObj))
+
+
+# Entry points that play the part of WebKit
+
+def post_message(view, name, body):
+    ''' Delivers a script message, as if the page had called
+    `window.webkit.messageHandlers[name].postMessage(body)`. '''
+    controller = view.user_content_controller
+    message = NSObj()
+    message.name = NSString(name)
+    message.body = ns(body)
+    controller.handlers[name].userContentController_didReceiveScriptMessage_(
+        controller, message)
+
+
+def decide_policy(view_or_webview, url, main=True):
+    ''' Asks the navigation delegate whether to allow navigating to
+    `url`, and returns its decision. '''
+    webview = view_or_webview if isinstance(view_or_webview, WebView) \
+        else view_or_webview.webview
+    decision = []
+    decision_handler = NativeBlock(decision.append, c_long)
+    webview._props['navigationDelegate'].\
+        webView_decidePolicyForNavigationAction_decisionHandler_(
+            webview, NavigationAction(url, main), decision_handler)
+    return bool(decision and decision[0])
+
+
+def navigate(view, url):
+    ''' Loads `url` in the view right away, running all the navigation
+    delegate callbacks. '''
+    return view.webview.navigate(url)
+
+
+def start_scheme_task(view, url):
+    ''' Starts loading `url` with the custom url scheme handler of the
+    view, and returns the task with the received `events`. '''
+    handlers = view.webview.configuration()._props['schemeHandlers']
+    task = URLSchemeTask(url)
+    handlers[url.partition(':')[0]].webView_startURLSchemeTask_(
+        view.webview, task)
+    return task
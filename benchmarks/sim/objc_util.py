@@ -0,0 +1,369 @@
+'''
+Pure-Python stand-in for Pythonista's objc_util, for running wkwebview
+off-device. Only covers what wkwebview uses, and only simulates behaviour,
+see fake_webkit for the WebKit side.
+
+ObjC objects are Python objects with a fake pointer, registered so that
+`ObjCInstance(ptr)` finds them again like in Pythonista. Unknown methods
+and properties return placeholder objects, and `set...` methods store
+properties that can be read back.
+'''
+
+from ctypes import *
+import ctypes, itertools, collections, functools, weakref
+
+_registry = weakref.WeakValueDictionary()
+_pointers = itertools.count(0x10000, 16)
+
+# Work that WebKit would do later on the main thread, see run_pending
+pending = collections.deque()
+
+
+def run_pending():
+    while pending:
+        pending.popleft()()
+
+
+class _InstanceType(type):
+
+    def __call__(cls, *args, **kwargs):
+        # ObjCInstance(ptr) looks up an existing object, like in Pythonista
+        if cls is ObjCInstance:
+            ptr = args[0]
+            if isinstance(ptr, ObjCInstance):
+                return ptr
+            return _registry[getattr(ptr, 'value', ptr)]
+        return super().__call__(*args, **kwargs)
+
+
+class ObjCInstance(metaclass=_InstanceType):
+
+    class_names = ('NSObject',)
+
+    def __new__(cls, *args, **kwargs):
+        obj = object.__new__(cls)
+        object.__setattr__(obj, 'ptr', next(_pointers))
+        object.__setattr__(obj, '_props', {})
+        _registry[obj.ptr] = obj
+        return obj
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @property
+    def _as_parameter_(self):
+        return self.ptr
+
+    def __setattr__(self, name, value):
+        if name.startswith('_') or name == 'ptr':
+            object.__setattr__(self, name, value)
+        else:
+            self._props[name] = value
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name.startswith('set') and name.endswith('_') and \
+                name.count('_') == 1:
+            key = name[3].lower() + name[4:-1]
+            return lambda value: self._props.__setitem__(key, value)
+        if '_' not in name:
+            return lambda: self._props.setdefault(name, NSObj())
+        return lambda *args: NSObj()
+
+    def isKindOfClass_(self, objc_class):
+        return objc_class.name in type(self).class_names
+
+    def autorelease(self):
+        return self
+
+    def retain(self):
+        return self
+
+    def release(self):
+        pass
+
+    def init(self):
+        return self
+
+
+class NSObj(ObjCInstance):
+    pass
+
+
+class NSString(ObjCInstance):
+
+    class_names = ('NSString', 'NSObject')
+
+    def __init__(self, value=''):
+        self._value = value
+
+    def __str__(self):
+        return self._value
+
+    def length(self):
+        return len(self._value)
+
+    def UTF8String(self):
+        return self._value.encode('utf-8')
+
+
+class NSNumber(ObjCInstance):
+
+    class_names = ('NSNumber', 'NSValue', 'NSObject')
+
+    def __init__(self, value=0):
+        self._value = value
+
+    def __str__(self):
+        if isinstance(self._value, bool):
+            return '1' if self._value else '0'
+        return str(self._value)
+
+    def objCType(self):
+        if isinstance(self._value, bool):
+            return b'c'
+        if isinstance(self._value, int):
+            return b'q'
+        return b'd'
+
+    def boolValue(self):
+        return bool(self._value)
+
+    def longLongValue(self):
+        return int(self._value)
+
+    def doubleValue(self):
+        return float(self._value)
+
+
+class NSNull(ObjCInstance):
+
+    class_names = ('NSNull', 'NSObject')
+
+    def __str__(self):
+        return '<null>'
+
+
+class NSArray(ObjCInstance):
+
+    class_names = ('NSArray', 'NSObject')
+
+    def __init__(self, items=()):
+        self._items = [ns(item) for item in items]
+
+    def count(self):
+        return len(self._items)
+
+    def objectAtIndex_(self, index):
+        return self._items[index]
+
+    def __str__(self):
+        return '(' + ', '.join(str(item) for item in self._items) + ')'
+
+
+class NSDictionary(ObjCInstance):
+
+    class_names = ('NSDictionary', 'NSObject')
+
+    def __init__(self, items=None):
+        self._items = {key: ns(value) for key, value in (items or {}).items()}
+
+    def count(self):
+        return len(self._items)
+
+    def allKeys(self):
+        return NSArray(list(self._items))
+
+    def objectForKey_(self, key):
+        return self._items.get(str(key))
+
+    def __str__(self):
+        return '{' + '; '.join(
+            f'{key} = {value}' for key, value in self._items.items()) + '}'
+
+
+class NSData(ObjCInstance):
+
+    class_names = ('NSData', 'NSObject')
+
+    def __init__(self, data=b''):
+        self._data = bytes(data)
+        self._buffer = ctypes.create_string_buffer(
+            self._data, len(self._data) or 1)
+
+    def bytes(self):
+        return ctypes.addressof(self._buffer)
+
+    def length(self):
+        return len(self._data)
+
+
+class NSURL(ObjCInstance):
+
+    class_names = ('NSURL', 'NSObject')
+
+    def __init__(self, url=''):
+        self._url = url
+
+    def __str__(self):
+        return self._url
+
+    def absoluteString(self):
+        return NSString(self._url)
+
+    def scheme(self):
+        return NSString(self._url.partition(':')[0])
+
+    def host(self):
+        rest = self._url.partition('://')[2]
+        return NSString(rest.split('/')[0].split(':')[0])
+
+    @staticmethod
+    def fileURLWithPath_(path):
+        return NSURL('file://' + str(path))
+
+    @staticmethod
+    def URLWithString_(url):
+        return NSURL(str(url))
+
+
+def ns(value):
+    if value is None or isinstance(value, ObjCInstance):
+        return value
+    if isinstance(value, str):
+        return NSString(value)
+    if isinstance(value, (bool, int, float)):
+        return NSNumber(value)
+    if isinstance(value, (bytes, bytearray)):
+        return NSData(value)
+    if isinstance(value, (list, tuple)):
+        return NSArray(value)
+    if isinstance(value, dict):
+        return NSDictionary(value)
+    raise TypeError(f'Cannot convert {type(value).__name__} to ObjC')
+
+
+def nsurl(url):
+    return NSURL(url)
+
+
+class ObjCBlock(ObjCInstance):
+    ''' Block created in Python. Calling it calls the function with the
+    block pointer and the pointers of the arguments, like ObjC would. '''
+
+    def __init__(self, func, restype=None, argtypes=None):
+        self._func = func
+
+    def __call__(self, *args):
+        return self._func(self.ptr, *[
+            arg.ptr if isinstance(arg, ObjCInstance) else arg
+            for arg in args])
+
+
+class NativeBlock(ObjCInstance):
+    ''' Block created by WebKit, with a real ctypes block literal layout so
+    that wkwebview can invoke it through `_block_literal_fields`. '''
+
+    def __new__(cls, func, *argtypes):
+        literal_type = _block_literal(*argtypes)
+        literal = literal_type()
+        invoke = literal_type._fields_[3][1](
+            lambda block, *args: func(*args))
+        literal.invoke = invoke
+        obj = object.__new__(cls)
+        object.__setattr__(obj, 'ptr', addressof(literal))
+        object.__setattr__(obj, '_props', {})
+        obj._literal = literal
+        obj._invoke = invoke
+        _registry[obj.ptr] = obj
+        return obj
+
+
+class _block_descriptor(Structure):
+    _fields_ = [('reserved', c_ulong), ('size', c_ulong),
+        ('copy_helper', c_void_p), ('dispose_helper', c_void_p),
+        ('signature', c_char_p)]
+
+
+@functools.lru_cache()
+def _block_literal(*argtypes):
+
+    class _literal(Structure):
+        _fields_ = [('isa', c_void_p), ('flags', c_int), ('reserved', c_int),
+            ('invoke', CFUNCTYPE(c_void_p, c_void_p, *argtypes)),
+            ('descriptor', _block_descriptor)]
+
+    return _literal
+
+
+def on_main_thread(func):
+    # Everything runs on the calling thread
+    return func
+
+
+class _Class:
+
+    def __init__(self, name, instance_type=NSObj, class_methods=None,
+            methods=()):
+        self.name = name
+        self.instance_type = instance_type
+        self.class_methods = class_methods or {}
+        self.methods = list(methods)
+
+    def new(self):
+        obj = self.instance_type()
+        # Methods of classes created with create_objc_class get the self
+        # and _cmd pointers, and pointers for the arguments
+        for method in self.methods:
+            def bound(*args, _method=method):
+                return _method(obj.ptr, 0, *[
+                    arg.ptr if isinstance(arg, ObjCInstance) else arg
+                    for arg in args])
+            object.__setattr__(obj, method.__name__, bound)
+        return obj
+
+    alloc = new
+
+    def __getattr__(self, name):
+        if name in self.class_methods:
+            return self.class_methods[name]
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args: NSObj()
+
+
+_classes = {}
+
+
+def ObjCClass(name):
+    if name not in _classes:
+        import fake_webkit
+        _classes[name] = fake_webkit.objc_class(name)
+    return _classes[name]
+
+
+def create_objc_class(name, superclass=None, methods=(), protocols=(),
+        classmethods=()):
+    return _Class(name, NSObj, methods=methods)
+
+
+NSObject = _Class('NSObject')
+UIApplication = _Class('UIApplication')
+
+# C functions are not available
+c = None
+
+CGFloat = c_double
+
+
+class CGPoint(Structure):
+    _fields_ = [('x', CGFloat), ('y', CGFloat)]
+
+
+class CGSize(Structure):
+    _fields_ = [('width', CGFloat), ('height', CGFloat)]
+
+
+class CGRect(Structure):
+    _fields_ = [('origin', CGPoint), ('size', CGSize)]
@@ -0,0 +1,78 @@
+'''
+Stand-in for Pythonista's ui module, see objc_util.
+'''
+
+import threading
+from objc_util import NSObj
+
+
+class Rect(tuple):
+
+    def inset(self, *args):
+        return self
+
+
+class View:
+
+    def __init__(self, **kwargs):
+        self.frame = Rect((0, 0, 320, 480))
+        self.name = None
+        self.superview = None
+        self.subviews = []
+        self.objc_instance = NSObj()
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    @property
+    def width(self):
+        return self.frame[2]
+
+    @property
+    def height(self):
+        return self.frame[3]
+
+    @property
+    def bounds(self):
+        return Rect((0, 0, self.width, self.height))
+
+    def add_subview(self, view):
+        self.subviews.append(view)
+        view.superview = self
+
+    def remove_subview(self, view):
+        self.subviews.remove(view)
+        view.superview = None
+
+    def present(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+class Image:
+
+    def __init__(self, data=None):
+        self.data = data
+
+    @classmethod
+    def from_data(cls, data, scale=1.0):
+        return cls(data)
+
+
+def in_background(func):
+    def wrapper(*args, **kwargs):
+        threading.Thread(target=func, args=args, kwargs=kwargs).start()
+    return wrapper
+
+
+def delay(func, seconds):
+    threading.Timer(seconds, func).start()
+
+
+def cancel_delays():
+    pass
+
+
+def parse_color(color):
+    return (0.0, 0.0, 0.0, 1.0)
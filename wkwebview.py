@@ -7,7 +7,10 @@ __version__ = '1.0'
 
 from objc_util import  *
 import ui, console, webbrowser
-import queue, weakref, ctypes, functools, time, os, json, re
+import weakref, ctypes, functools, time, os, json, re
+import concurrent.futures, itertools, asyncio, threading
+import collections, traceback, hashlib, base64, bisect
+import mimetypes, mmap, urllib.parse, zipfile
 from types import SimpleNamespace
 
 
@@ -32,6 +35,552 @@ def _block_literal_fields(*arg_types):
     ]
 
 
+class _Retainer:
+    """ Keeps ObjC blocks, handlers and delegates alive while ObjC code can
+    still call them.
+
+    A released object is only dropped on the next retain or release in the
+    same thread, so that a block can release itself at the end of its own
+    invocation while other threads keep retaining and releasing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = itertools.count()
+        self._live = {}
+        self._released = threading.local()
+
+    def token(self):
+        return next(self._tokens)
+
+    def retain(self, obj, token=None):
+        if token is None:
+            token = self.token()
+        self._released.obj = None
+        with self._lock:
+            self._live[token] = obj
+        return token
+
+    def release(self, token):
+        with self._lock:
+            obj = self._live.pop(token, None)
+        self._released.obj = obj
+
+    def __len__(self):
+        # The deferred drop of a released object does not count, it is no
+        # longer reachable by ObjC
+        return len(self._live)
+
+_retained = _Retainer()
+
+# Views by the pointers of their ObjC delegates and handlers, so that the
+# callbacks find the view without wrapping their `_self` argument
+_delegate_views = weakref.WeakValueDictionary()
+
+
+def _completion_block(callback, *argtypes):
+    """ One-shot ObjC completion block that calls `callback` with the
+    block arguments as raw pointers, and is released after the call. """
+    token = _retained.token()
+    def invoke(_cmd, *args):
+        try:
+            callback(*args)
+        finally:
+            _retained.release(token)
+    block = ObjCBlock(invoke, restype=None, argtypes=[c_void_p, *argtypes])
+    _retained.retain(block, token)
+    return block
+
+
+class _lazy:
+    """ Class attribute that is only created on first access, to keep ObjC
+    class lookups and runtime class creation out of the module import. """
+
+    _lock = threading.RLock()
+
+    def __init__(self, factory, *args, **kwargs):
+        self.factory = functools.partial(factory, *args, **kwargs)
+
+    def __set_name__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def __get__(self, instance, owner):
+        with _lazy._lock:
+            value = self.owner.__dict__[self.name]
+            if value is self:
+                value = self.factory()
+                # Replaces this descriptor, later access is a plain lookup
+                setattr(self.owner, self.name, value)
+            return value
+
+
+def _objc_key(obj):
+    # Hashable identity of an ObjC object, given as an ObjCInstance or as a
+    # raw pointer received in a callback
+    ptr = getattr(obj, 'ptr', obj)
+    return getattr(ptr, 'value', ptr)
+
+
+def objc_to_python(obj):
+    """ Converts an ObjC object (or a pointer to one) to the corresponding
+    native Python value, recursively:
+
+      * NSString - `str`
+      * NSNumber - `bool`, `int` or `float`
+      * NSArray - `list`
+      * NSDictionary - `dict`
+      * NSNull - `None`
+      * NSData - `bytes`
+
+    Other objects are converted with `str`. Integral floating point numbers
+    are returned as `int`, the same way as parsing them from JSON would.
+    """
+    if not obj:
+        return None
+    if not isinstance(obj, ObjCInstance):
+        obj = ObjCInstance(obj)
+    if obj.isKindOfClass_(WKWebView.NSString):
+        return str(obj)
+    if obj.isKindOfClass_(WKWebView.NSNumber):
+        kind = obj.objCType()
+        if isinstance(kind, bytes):
+            kind = kind.decode()
+        if kind in ('c', 'B'):
+            return bool(obj.boolValue())
+        if kind in ('d', 'f'):
+            value = float(obj.doubleValue())
+            if value.is_integer() and abs(value) < 2**53:
+                return int(value)
+            return value
+        return int(obj.longLongValue())
+    if obj.isKindOfClass_(WKWebView.NSArray):
+        return [
+            objc_to_python(obj.objectAtIndex_(i))
+            for i in range(obj.count())
+        ]
+    if obj.isKindOfClass_(WKWebView.NSDictionary):
+        keys = obj.allKeys()
+        return {
+            str(key): objc_to_python(obj.objectForKey_(key))
+            for key in (keys.objectAtIndex_(i) for i in range(keys.count()))
+        }
+    if obj.isKindOfClass_(WKWebView.NSNull):
+        return None
+    if obj.isKindOfClass_(WKWebView.NSData):
+        return ctypes.string_at(obj.bytes(), obj.length())
+    return str(obj)
+
+
+def _image_data(image, image_format='png', quality=0.9):
+    # PNG or JPEG encoded bytes of an UIImage
+    if image_format == 'jpeg':
+        encode = c.UIImageJPEGRepresentation
+        encode.argtypes = [c_void_p, CGFloat]
+        args = (image, quality)
+    else:
+        encode = c.UIImagePNGRepresentation
+        encode.argtypes = [c_void_p]
+        args = (image,)
+    encode.restype = c_void_p
+    data = ObjCInstance(encode(*args))
+    return ctypes.string_at(data.bytes(), data.length())
+
+
+def message_options(coalesce=False, max_pending=None):
+    """ Decorator for `on_` message handler methods.
+
+      * `coalesce` - if True, only the latest of the messages waiting to be
+        handled is delivered, e.g. for scroll positions or sensor values.
+      * `max_pending` - maximum number of messages waiting to be handled when
+        messages are dispatched with a `message_executor`. The oldest
+        messages are dropped when the limit is exceeded.
+    """
+    def decorator(func):
+        func.message_options = {
+            'coalesce': coalesce, 'max_pending': max_pending}
+        return func
+    return decorator
+
+
+class _MessageHandler:
+    """ Delivers messages to one `on_` handler in order, on the calling
+    (main) thread, in a `concurrent.futures.Executor` or in an asyncio event
+    loop. """
+
+    def __init__(self, func, executor=None, coalesce=False, max_pending=None,
+            metrics=None, name=None):
+        if executor is None and asyncio.iscoroutinefunction(func):
+            raise TypeError(
+                f'Coroutine handler {name or func!r} needs a '
+                f'message_executor (an asyncio event loop or an executor)')
+        self.func = func
+        self.metrics = metrics
+        self.name = name
+        self.executor = executor
+        self.coalesce = coalesce
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.dropped = 0
+
+    def deliver(self, messages):
+        if self.coalesce:
+            messages = messages[-1:]
+        if self.executor is None:
+            for message in messages:
+                self._call(message)
+            return
+        with self.lock:
+            if self.coalesce:
+                self.dropped += len(self.pending)
+                self.pending.clear()
+            self.pending.extend(messages)
+            if self.max_pending is not None:
+                while len(self.pending) > self.max_pending:
+                    self.pending.popleft()
+                    self.dropped += 1
+            if self.scheduled:
+                return
+            self.scheduled = True
+        if isinstance(self.executor, asyncio.AbstractEventLoop):
+            asyncio.run_coroutine_threadsafe(self._drain_aio(), self.executor)
+        else:
+            self.executor.submit(self._drain)
+
+    def _next_message(self, messages):
+        with self.lock:
+            if not self.pending:
+                self.scheduled = False
+                return False
+            messages.append(self.pending.popleft())
+            return True
+
+    def _drain(self):
+        messages = []
+        while self._next_message(messages):
+            try:
+                result = self._call(messages.pop())
+                if asyncio.iscoroutine(result):
+                    # Executor thread, which has no event loop
+                    loop = asyncio.new_event_loop()
+                    try:
+                        loop.run_until_complete(result)
+                    finally:
+                        loop.close()
+            except Exception:
+                traceback.print_exc()
+
+    async def _drain_aio(self):
+        # Awaits each coroutine handler before taking the next message, so
+        # that messages are handled in order and max_pending applies
+        messages = []
+        while self._next_message(messages):
+            try:
+                result = self._call(messages.pop())
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                traceback.print_exc()
+
+    def _call(self, message):
+        if self.metrics is None:
+            return self.func(message)
+        started = time.perf_counter()
+        try:
+            return self.func(message)
+        finally:
+            self.metrics.observe(
+                f'message.{self.name}.handler', time.perf_counter() - started)
+
+
+class JavascriptError(RuntimeError):
+    """ Raised or returned for javascript that threw an exception. """
+
+
+class NavigationError(RuntimeError):
+    """ Raised when loading a page fails. """
+
+    def __init__(self, code, message):
+        super().__init__(
+            f'WKWebView load failed with code {code}: {message}')
+        self.code = code
+        self.message = message
+
+
+class NavigationHandle(concurrent.futures.Future):
+    """ Future for a page load, returned by `load_url` and `load_html`.
+
+    The result is the url of the loaded page, and `NavigationError` is
+    raised if loading fails. Can also be awaited in an asyncio event loop.
+    """
+
+    def __init__(self, navigation, until='finish'):
+        super().__init__()
+        self.navigation = navigation
+        self.until = until
+
+    def wait(self, timeout=None):
+        """ Waits for the load to complete or fail, and returns True if it
+        did within `timeout` seconds. """
+        concurrent.futures.wait([self], timeout)
+        return self.done()
+
+    def __await__(self):
+        return asyncio.wrap_future(self).__await__()
+
+
+class MemoryAssets:
+    """ Custom scheme provider that serves assets from a dict of paths to
+    `bytes` or `str` contents. """
+
+    def __init__(self, assets=None):
+        self.assets = dict(assets or {})
+
+    def __call__(self, path):
+        content = self.assets.get(path)
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return content
+
+
+class ZipAssets:
+    """ Custom scheme provider that serves assets from a zip archive,
+    without extracting it. `prefix` is a directory inside the archive to
+    serve the assets from. """
+
+    def __init__(self, zip_file, prefix=''):
+        self.zip_file = zipfile.ZipFile(zip_file)
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    def __call__(self, path):
+        try:
+            return self.zip_file.open(self.prefix + path)
+        except KeyError:
+            return None
+
+
+class FileAssets:
+    """ Custom scheme provider that serves files under the `root`
+    directory as memory-mapped buffers. """
+
+    def __init__(self, root):
+        self.root = os.path.realpath(os.path.expanduser(root))
+
+    def __call__(self, path):
+        file_path = os.path.realpath(os.path.join(self.root, path))
+        if not file_path.startswith(self.root + os.sep) or \
+                not os.path.isfile(file_path):
+            return None
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _LRUCache:
+    """ Least recently used cache limited by the total size of the cached
+    values. """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        # Values are (content, mime type) tuples
+        if len(value[0]) > self.max_size:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._items[key] = value
+            self.size += len(value[0])
+            while self.size > self.max_size:
+                _, (content, _) = self._items.popitem(last=False)
+                self.size -= len(content)
+
+
+class _Metrics:
+    """ Counters and latency histograms of one WKWebView, see
+    `WKWebView.metrics`. """
+
+    # Upper bounds of the histogram buckets, in seconds
+    buckets = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+        0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._histograms = {}
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+        if self.hook is not None:
+            self.hook('count', name, amount)
+
+    def observe(self, name, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = \
+                    [0, 0.0, 0.0, [0] * (len(self.buckets) + 1)]
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2] = max(histogram[2], seconds)
+            histogram[3][index] += 1
+        if self.hook is not None:
+            self.hook('time', name, seconds)
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                name: self._summary(*histogram)
+                for name, histogram in self._histograms.items()}
+            if reset:
+                self._counters.clear()
+                self._histograms.clear()
+        return {'counters': counters, 'histograms': histograms}
+
+    def _summary(self, count, total, maximum, bucket_counts):
+        summary = {'count': count, 'mean': total / count, 'max': maximum}
+        # Percentiles are estimated as the upper bound of their bucket
+        for percentile in (50, 90, 99):
+            rank = count * percentile / 100
+            seen = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                seen += bucket_count
+                if seen >= rank:
+                    summary[f'p{percentile}'] = min(bound, maximum)
+                    break
+            else:
+                summary[f'p{percentile}'] = maximum
+        summary['buckets'] = bucket_counts[:]
+        return summary
+
+
+class NavigationRules:
+    """ Declarative allow and deny rules for navigations, matched by host
+    suffix, scheme or url regex. Deny rules win over allow rules.
+
+    Rules are compiled once into an index, so that navigations they match
+    are decided without calling the delegate. Deny rules can also be
+    compiled into a WebKit content rule list, which blocks matching page
+    and resource loads inside WebKit. """
+
+    def __init__(self):
+        self._rules = {True: ([], [], []), False: ([], [], [])}
+        self._index = None
+
+    def allow(self, hosts=(), schemes=(), urls=()):
+        """ Allows navigations to `hosts` and their subdomains, to urls with
+        one of `schemes`, and to urls matching one of the `urls` regexes.
+        Returns the rules, for chaining. """
+        return self._add(True, hosts, schemes, urls)
+
+    def deny(self, hosts=(), schemes=(), urls=()):
+        """ Like `allow`, but cancels the navigations. """
+        return self._add(False, hosts, schemes, urls)
+
+    def _add(self, allow, hosts, schemes, urls):
+        for rules, values in zip(self._rules[allow], (hosts, schemes, urls)):
+            if isinstance(values, str):
+                values = [values]
+            rules.extend(values)
+        self._index = None
+        return self
+
+    def _compile(self):
+        index = {}
+        for allow, (hosts, schemes, urls) in self._rules.items():
+            index[allow] = (
+                frozenset(host.lower().strip('.') for host in hosts),
+                frozenset(scheme.lower() for scheme in schemes),
+                re.compile('|'.join(f'(?:{url})' for url in urls))
+                    if urls else None)
+        self._index = index
+        return index
+
+    def decide(self, url):
+        """ Returns False if a deny rule matches `url`, True if an allow
+        rule matches, and None if no rule matches. """
+        index = self._index or self._compile()
+        parts = urllib.parse.urlsplit(url)
+        host = parts.hostname or ''
+        labels = host.split('.')
+        suffixes = ['.'.join(labels[i:]) for i in range(len(labels))]
+        for allow in (False, True):
+            hosts, schemes, urls = index[allow]
+            if parts.scheme.lower() in schemes or \
+                    not hosts.isdisjoint(suffixes) or \
+                    urls is not None and urls.search(url):
+                return allow
+        return None
+
+    @staticmethod
+    def _check_url_filter(url):
+        # WebKit content blockers only support a small regex subset: ascii
+        # literals and escapes, '.', character ranges, '*', '+', '?',
+        # groups and the '^' and '$' anchors
+        escaped = in_range = False
+        for i, char in enumerate(url):
+            unsupported = None
+            if ord(char) > 127:
+                unsupported = 'non-ascii characters'
+            elif escaped:
+                if char.isalnum():
+                    unsupported = "'\\" + char + "'"
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif in_range:
+                in_range = char != ']'
+            elif char == '[':
+                in_range = True
+            elif char in '|{}':
+                unsupported = f"'{char}'"
+            elif char == '(' and url[i + 1:i + 2] == '?':
+                unsupported = "'(?'"
+            if unsupported:
+                raise ValueError(
+                    f'Url rule {url!r} cannot be used to block content, '
+                    f'WebKit does not support {unsupported}; use several '
+                    'rules or block_content=False')
+
+    def content_rules(self):
+        """ Deny rules as WebKit content blocker JSON, or None if there are
+        no deny rules. """
+        hosts, schemes, urls = self._rules[False]
+        filters = [
+            '^[a-z][a-z0-9.+-]*://([^/:]+\\.)?' +
+            host.lower().strip('.').replace('.', '\\.') + '[:/]'
+            for host in hosts]
+        filters.extend('^' + scheme.lower() + ':' for scheme in schemes)
+        for url in urls:
+            NavigationRules._check_url_filter(url)
+        filters.extend(urls)
+        if not filters:
+            return None
+        return json.dumps([
+            {'trigger': {'url-filter': url_filter},
+             'action': {'type': 'block'}}
+            for url_filter in filters])
+
+
 class WKWebView(ui.View):
 
     # Data detector constants
@@ -45,12 +594,20 @@ class WKWebView(ui.View):
     LOOKUP_SUGGESTION = 1 << 6
     ALL = 18446744073709551615 # NSUIntegerMax
 
-    # Global webview index for console
-    webviews = []
-    console_view = UIApplication.sharedApplication().\
-        keyWindow().rootViewController().\
-        accessoryViewController().\
-        consoleViewController()
+    # How JS values are converted to Python, see objc_to_python
+    VALUE_FORMATS = ('str', 'native', 'json')
+
+    # Maximum number of results kept by eval_js(..., cache=True)
+    eval_js_cache_size = 128
+
+    # Live webviews by index, for console and live_count. Closed views stay
+    # until they are garbage collected, so that leaks show in live_count
+    webviews = weakref.WeakValueDictionary()
+    _webview_ids = itertools.count()
+    console_view = _lazy(lambda: UIApplication.sharedApplication().
+        keyWindow().rootViewController().
+        accessoryViewController().
+        consoleViewController())
 
     def __init__(self,
             swipe_navigation=False,
@@ -60,34 +617,119 @@ class WKWebView(ui.View):
             inline_media=None,
             airplay_media=True,
             pip_media=True,
+            eval_js_timeout=None,
+            value_format='str',
+            message_executor=None,
+            message_batch_size=100,
+            console_level='log',
+            console_log_size=1000,
+            schemes=None,
+            navigation_rules=None,
+            call_executor=None,
+            metrics=False,
+            metrics_hook=None,
+            ephemeral=False,
             **kwargs):
 
-        WKWebView.webviews.append(self)
+        self._webview_id = next(WKWebView._webview_ids)
+        WKWebView.webviews[self._webview_id] = self
+        self._closed = False
         self.delegate = None
+        self._pool = None
         self.log_js_evals = log_js_evals
         self.respect_safe_areas = respect_safe_areas
+        self.eval_js_timeout = eval_js_timeout
+        if value_format not in WKWebView.VALUE_FORMATS:
+            raise ValueError(f'Unknown value format: {value_format}')
+        self.value_format = value_format
         super().__init__(**kwargs)
 
-        self.eval_js_queue = queue.Queue()
+        self._metrics = _Metrics(metrics_hook) \
+            if metrics or metrics_hook is not None else None
+        self._navigation_started = None
+        self._navigation_timings = {}
+
+        self._eval_js_ids = itertools.count()
+        self._eval_js_futures = {}
+        self._eval_js_cache = collections.OrderedDict()
+        self._eval_js_cache_lock = threading.Lock()
+        self._eval_js_cache_generation = 0
+        self._transfer_ids = itertools.count()
+        self._navigations = weakref.WeakValueDictionary()
+        self._committed_navigation = None
+        self._message_subscribers = []
 
         custom_message_handler = WKWebView.CustomMessageHandler.\
             new().autorelease()
-        retain_global(custom_message_handler)
-        custom_message_handler._pythonistawebview = weakref.ref(self)
+        self._retain_tokens = [_retained.retain(custom_message_handler)]
+        # Views that are never closed release their handlers and delegates
+        # when garbage collected
+        self._release_retained = weakref.finalize(
+            self, WKWebView._release_tokens, self._retain_tokens)
+        _delegate_views[_objc_key(custom_message_handler)] = self
+        self._script_message_handler = custom_message_handler
 
         user_content_controller = WKWebView.WKUserContentController.\
             new().autorelease()
         self.user_content_controller = user_content_controller
-        for key in dir(self):
-            if key.startswith('on_'):
-                message_name = key[3:]
-                user_content_controller.addScriptMessageHandler_name_(
-                    custom_message_handler, message_name)
-
-        self.add_script(WKWebView.js_logging_script)
+        self.message_executor = message_executor
+        self._message_handlers = {}
+        for message_name in type(self)._handler_names():
+            handler = getattr(self, 'on_' + message_name)
+            self._message_handlers[message_name] = _MessageHandler(
+                handler, message_executor,
+                metrics=self._metrics, name=message_name,
+                **getattr(handler, 'message_options', {}))
+            user_content_controller.addScriptMessageHandler_name_(
+                custom_message_handler, message_name)
+        user_content_controller.addScriptMessageHandler_name_(
+            custom_message_handler, WKWebView._batch_channel)
+        user_content_controller.addScriptMessageHandler_name_(
+            custom_message_handler, WKWebView._data_channel)
+        self._incoming = {}
+        user_content_controller.addScriptMessageHandler_name_(
+            custom_message_handler, WKWebView._call_channel)
+        user_content_controller.addScriptMessageHandler_name_(
+            custom_message_handler, WKWebView._dom_channel)
+        user_content_controller.addScriptMessageHandler_name_(
+            custom_message_handler, WKWebView._observe_channel)
+        self._observer_ids = itertools.count(1)
+        self._observers = {}
+        self.call_executor = call_executor
+        self._exposed = {}
+        self._call_results = []
+        self._call_flush_scheduled = False
+        self._call_lock = threading.Lock()
+
+        # Internal scripts, styles and meta tags are bundled into one
+        # WKUserScript per injection time, see _user_script_bundles
+        self._internal_scripts = {}
+        self._user_scripts = ({}, {})
+        self._user_styles = {}
+        self._user_metas = {}
+        self._installed_bundles = None
+
+        self._message_batch_size = message_batch_size
+        self._internal_scripts['messages'] = self._message_script()
+        self._internal_scripts['data'] = WKWebView.js_data_script
+        self._internal_scripts['send'] = self._send_script()
+        self._internal_scripts['calls'] = WKWebView.js_call_script
+        self._internal_scripts['dom'] = WKWebView.js_dom_script
+        self._internal_scripts['observe'] = WKWebView.js_observe_script
+        if console_level not in WKWebView.CONSOLE_LEVELS:
+            raise ValueError(f'Unknown console level: {console_level}')
+        self._console_log = collections.deque(maxlen=console_log_size)
+        self._internal_scripts['console'] = self._logging_script(
+            console_level, console_log_size)
+        self._install_user_scripts()
 
         webview_config = WKWebView.WKWebViewConfiguration.new().autorelease()
         webview_config.userContentController = user_content_controller
+        webview_config.setProcessPool_(WKWebView.shared_process_pool)
+        self._data_store = \
+            WKWebView.WKWebsiteDataStore.nonPersistentDataStore() \
+            if ephemeral else WKWebView.WKWebsiteDataStore.defaultDataStore()
+        webview_config.setWebsiteDataStore_(self._data_store)
 
         data_detectors = sum(data_detectors) if type(data_detectors) is tuple \
             else data_detectors
@@ -105,16 +747,514 @@ class WKWebView(ui.View):
         webview_config.allowsPictureInPictureMediaPlayback = pip_media
 
         nav_delegate = WKWebView.CustomNavigationDelegate.new()
-        retain_global(nav_delegate)
-        nav_delegate._pythonistawebview = weakref.ref(self)
+        self._retain_tokens.append(_retained.retain(nav_delegate))
+        _delegate_views[_objc_key(nav_delegate)] = self
 
         ui_delegate = WKWebView.CustomUIDelegate.new()
-        retain_global(ui_delegate)
-        ui_delegate._pythonistawebview = weakref.ref(self)
+        self._retain_tokens.append(_retained.retain(ui_delegate))
+        _delegate_views[_objc_key(ui_delegate)] = self
+
+        self._scheme_providers = dict(WKWebView.scheme_providers)
+        for scheme in schemes or {}:
+            WKWebView._check_scheme(scheme)
+        self._scheme_providers.update(schemes or {})
+        self._scheme_tasks = {}
+        if self._scheme_providers:
+            scheme_handler = WKWebView.CustomURLSchemeHandler.new()
+            self._retain_tokens.append(_retained.retain(scheme_handler))
+            _delegate_views[_objc_key(scheme_handler)] = self
+            for scheme in self._scheme_providers:
+                webview_config.setURLSchemeHandler_forURLScheme_(
+                    scheme_handler, scheme)
 
         self._create_webview(webview_config, nav_delegate, ui_delegate)
 
         self.swipe_navigation = swipe_navigation
+        self._default_swipe_navigation = swipe_navigation
+
+        self._navigation_rules = None
+        self._content_rules_id = None
+        if navigation_rules is not None:
+            self.set_navigation_rules(navigation_rules).add_done_callback(
+                self._content_rules_installed)
+
+    # Custom url schemes
+
+    scheme_providers = {}
+    scheme_chunk_size = 256 * 1024
+    scheme_cache = _LRUCache(16 * 1024 * 1024)
+    scheme_cache_item_size = 1024 * 1024
+    _scheme_executor = _lazy(
+        concurrent.futures.ThreadPoolExecutor, max_workers=4)
+
+    @classmethod
+    def register_scheme(cls, scheme, provider):
+        """ Registers a provider for serving `scheme://` urls from Python,
+        for all views created after the call. Use the `schemes` constructor
+        parameter to register providers for one view only.
+
+        A provider is called with the path part of the url, and should
+        return `None` (not found), `bytes`-like content, a binary file
+        object, or a tuple of content and mime type. `MemoryAssets`,
+        `ZipAssets` and `FileAssets` are ready-made providers.
+        """
+        cls._check_scheme(scheme)
+        cls.scheme_providers[scheme] = provider
+
+    @staticmethod
+    def _check_scheme(scheme):
+        # WebKit raises an ObjC exception for the schemes it handles itself
+        if WKWebView._webkit_handles_scheme(scheme):
+            raise ValueError(
+                f'Scheme {scheme!r} is handled by WebKit, use another name')
+
+    def _start_scheme_task(self, task):
+        key = _objc_key(task)
+        self._scheme_tasks[key] = task
+        url = str(task.request().URL())
+        WKWebView._scheme_executor.submit(self._serve_scheme_task, key, url)
+
+    def _stop_scheme_task(self, task):
+        self._scheme_tasks.pop(_objc_key(task), None)
+
+    def _serve_scheme_task(self, key, url):
+        # Runs in the executor, where an uncaught exception would leave the
+        # load hanging
+        try:
+            self._serve_scheme(key, url)
+        except Exception as e:
+            traceback.print_exc()
+            self._scheme_failed(key, f'{type(e).__name__}: {e}')
+
+    def _serve_scheme(self, key, url):
+        # The host is ignored, so that relative urls resolve under it like
+        # with http, e.g. `app://app/index.html` loading `js/app.js`
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.unquote(parts.path).lstrip('/')
+        provider = self._scheme_providers[parts.scheme]
+        # Keyed by the provider itself, as the id of a collected per-view
+        # provider can be reused by a new one
+        cache_key = (provider, path)
+        cached = WKWebView.scheme_cache.get(cache_key)
+        if cached is not None:
+            content, mime_type = cached
+            self._scheme_response(key, 200, mime_type, content, True)
+            return
+        try:
+            content = provider(path)
+        except Exception:
+            traceback.print_exc()
+            self._scheme_response(key, 500, 'text/plain', b'', True)
+            return
+        if content is None:
+            self._scheme_response(key, 404, 'text/plain', b'', True)
+            return
+        mime_type = None
+        if isinstance(content, tuple):
+            content, mime_type = content
+        if mime_type is None:
+            mime_type = mimetypes.guess_type(path)[0] or \
+                'application/octet-stream'
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        try:
+            if hasattr(content, 'read') and \
+                    not isinstance(content, mmap.mmap):
+                self._stream_scheme_file(key, cache_key, mime_type, content)
+            else:
+                self._stream_scheme_buffer(key, mime_type, content)
+        finally:
+            if hasattr(content, 'close'):
+                content.close()
+
+    def _stream_scheme_buffer(self, key, mime_type, content):
+        chunk_size = WKWebView.scheme_chunk_size
+        size = len(content)
+        if size <= chunk_size:
+            self._scheme_response(key, 200, mime_type, bytes(content), True)
+            return
+        if not self._scheme_response(key, 200, mime_type, size=size):
+            return
+        view = memoryview(content)
+        try:
+            for start in range(0, size, chunk_size):
+                if not self._scheme_data(
+                        key, bytes(view[start:start+chunk_size])):
+                    return
+        finally:
+            view.release()
+        self._scheme_data(key, None, finish=True)
+
+    def _stream_scheme_file(self, key, cache_key, mime_type, content):
+        chunk_size = WKWebView.scheme_chunk_size
+        chunk = content.read(chunk_size)
+        if len(chunk) < chunk_size:
+            WKWebView.scheme_cache.put(cache_key, (chunk, mime_type))
+            self._scheme_response(key, 200, mime_type, chunk, True)
+            return
+        if not self._scheme_response(key, 200, mime_type):
+            return
+        # Small enough assets are kept for the cache while streaming
+        cached = []
+        cached_size = 0
+        while chunk:
+            if cached is not None:
+                cached.append(chunk)
+                cached_size += len(chunk)
+                if cached_size > WKWebView.scheme_cache_item_size:
+                    cached = None
+            if not self._scheme_data(key, chunk):
+                return
+            chunk = content.read(chunk_size)
+        if cached is not None:
+            WKWebView.scheme_cache.put(
+                cache_key, (b''.join(cached), mime_type))
+        self._scheme_data(key, None, finish=True)
+
+    @on_main_thread
+    def _scheme_response(self, key, status, mime_type,
+            content=None, finish=False, size=None):
+        # Returns False if the task has been stopped by WebKit
+        task = self._scheme_tasks.get(key)
+        if task is None:
+            return False
+        headers = {'Content-Type': mime_type}
+        if content is not None:
+            size = len(content)
+        if size is not None:
+            headers['Content-Length'] = str(size)
+        response = WKWebView.NSHTTPURLResponse.alloc().\
+            initWithURL_statusCode_HTTPVersion_headerFields_(
+                task.request().URL(), status, 'HTTP/1.1', ns(headers)).\
+            autorelease()
+        task.didReceiveResponse_(response)
+        if content is not None:
+            return self._scheme_data(key, content, finish)
+        return True
+
+    @on_main_thread
+    def _scheme_failed(self, key, message):
+        task = self._scheme_tasks.pop(key, None)
+        if task is None:
+            return
+        error = WKWebView.NSError.errorWithDomain_code_userInfo_(
+            'NSURLErrorDomain', -1, ns({'NSLocalizedDescription': message}))
+        task.didFailWithError_(error)
+
+    @on_main_thread
+    def _scheme_data(self, key, chunk, finish=False):
+        task = self._scheme_tasks.get(key)
+        if task is None:
+            return False
+        if chunk:
+            task.didReceiveData_(
+                WKWebView.NSData.dataWithBytes_length_(chunk, len(chunk)))
+        if finish:
+            del self._scheme_tasks[key]
+            task.didFinish()
+        return True
+
+    # Snapshots
+
+    SNAPSHOT_FORMATS = ('png', 'jpeg', 'image')
+    _snapshot_executor = _lazy(
+        concurrent.futures.ThreadPoolExecutor, max_workers=2)
+
+    def snapshot(self, rect=None, width=None, image_format='png',
+            quality=0.9):
+        """ Takes a snapshot of the visible page, and returns a future for
+        the image as PNG or JPEG `bytes`, or as an `ui.Image` with
+        `image_format='image'`.
+
+          * `rect` - `(x, y, width, height)` of the area to capture, in
+            view coordinates; default is the whole view
+          * `width` - width of the image in points, the image is scaled to
+            it; default is the width of `rect`
+          * `quality` - JPEG compression quality between 0.0 and 1.0
+        """
+        return self._snapshot(rect, width, image_format, quality)
+
+    def _snapshot(self, rect, width, image_format, quality, captured=None):
+        if image_format not in WKWebView.SNAPSHOT_FORMATS:
+            raise ValueError(f'Unknown image format: {image_format}')
+        future = concurrent.futures.Future()
+
+        def completion(image, error):
+            if captured is not None:
+                captured.set()
+            if not image:
+                future.set_exception(RuntimeError(
+                    'Snapshot failed: ' +
+                    str(ObjCInstance(error).localizedDescription())))
+                return
+            # Encoding can take longer than the capture, and is done
+            # outside the main thread
+            WKWebView._snapshot_executor.submit(self._encode_snapshot,
+                future, ObjCInstance(image), image_format, quality)
+
+        self._take_snapshot(rect, width, completion)
+        return future
+
+    @on_main_thread
+    def _take_snapshot(self, rect, width, completion):
+        config = WKWebView.WKSnapshotConfiguration.new().autorelease()
+        if rect is not None:
+            x, y, w, h = rect
+            config.setRect_(CGRect(CGPoint(x, y), CGSize(w, h)))
+        if width is not None:
+            config.setSnapshotWidth_(ns(width))
+        self.webview.takeSnapshotWithConfiguration_completionHandler_(
+            config, _completion_block(completion, c_void_p, c_void_p))
+
+    @staticmethod
+    def _encode_snapshot(future, image, image_format, quality):
+        try:
+            if image_format == 'image':
+                result = ui.Image.from_data(_image_data(image))
+            else:
+                result = _image_data(image, image_format, quality)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def render_batch(self, pages, rect=None, width=None, image_format='png',
+            quality=0.9, timeout=30):
+        """ Loads each html string in `pages` into this view in turn, and
+        takes a snapshot of it when it has finished loading. The next page
+        is loaded while the previous snapshot is being encoded.
+
+        Must be called outside the main thread. Returns a namespace with
+        the `images` in page order, the total `seconds` and
+        `pages_per_second`. """
+        started = time.perf_counter()
+        futures = []
+        for html in pages:
+            page_started = time.perf_counter()
+            self.load_html(html).result(timeout)
+            captured = threading.Event()
+            futures.append(self._snapshot(
+                rect, width, image_format, quality, captured))
+            if not captured.wait(timeout):
+                raise concurrent.futures.TimeoutError(
+                    'Snapshot was not taken in time')
+            if self._metrics is not None:
+                self._metrics.observe(
+                    'render.page', time.perf_counter() - page_started)
+        images = [future.result(timeout) for future in futures]
+        seconds = time.perf_counter() - started
+        return SimpleNamespace(
+            images=images,
+            seconds=seconds,
+            pages_per_second=len(images) / seconds if seconds else 0.0)
+
+    # Metrics
+
+    def metrics(self, reset=False):
+        """ Returns a snapshot of the counters and latency histograms
+        collected when the view was created with `metrics=True`, or None.
+        With `reset`, starts collecting from zero again. """
+        if self._metrics is None:
+            return None
+        return self._metrics.snapshot(reset)
+
+    def _count_messages(self, name, contents):
+        self._metrics.count(f'message.{name}.count', len(contents))
+        self._metrics.count(f'message.{name}.bytes', sum(
+            len(content) if isinstance(content, (str, bytes, memoryview))
+            else len(json.dumps(content, default=str))
+            for content in contents))
+
+    def _navigation_decided(self, nav_action, started):
+        self._metrics.observe(
+            'navigation.policy', time.perf_counter() - started)
+        frame = nav_action.targetFrame()
+        if frame is None or frame.isMainFrame():
+            self._navigation_started = started
+
+    def _navigation_committed(self, navigation):
+        committed = time.perf_counter()
+        started = self._navigation_started
+        self._navigation_started = None
+        if started is not None:
+            self._metrics.observe('navigation.commit', committed - started)
+        self._navigation_timings[_objc_key(navigation)] = (started, committed)
+
+    def _navigation_done(self, navigation, failed=False):
+        done = time.perf_counter()
+        started, committed = self._navigation_timings.pop(
+            _objc_key(navigation), (self._navigation_started, None))
+        if committed is None:
+            self._navigation_started = None
+        if failed:
+            self._metrics.count('navigation.failed')
+            return
+        if committed is not None:
+            self._metrics.observe('navigation.finish', done - committed)
+        if started is not None:
+            self._metrics.observe('navigation.total', done - started)
+
+    # Navigation rules
+
+    _content_rule_lists = {}
+
+    # Delegate methods, looked up once when the delegate is set
+    DELEGATE_METHODS = ('webview_should_start_load', 'webview_did_start_load',
+        'webview_did_finish_load', 'webview_did_fail_load')
+
+    @property
+    def delegate(self):
+        """ Object with any of the `DELEGATE_METHODS`, called on navigation.
+        The methods are looked up when the delegate is set. """
+        return self._delegate
+
+    @delegate.setter
+    def delegate(self, value):
+        self._delegate = value
+        self._delegate_methods = tuple(
+            getattr(value, name, None) for name in WKWebView.DELEGATE_METHODS)
+
+    # Results of handlesURLScheme_, which never change
+    _handled_schemes = {}
+
+    def _handles_scheme(self, scheme):
+        if scheme in self._scheme_providers:
+            return True
+        return WKWebView._webkit_handles_scheme(scheme)
+
+    @staticmethod
+    def _webkit_handles_scheme(scheme):
+        handled = WKWebView._handled_schemes.get(scheme)
+        if handled is None:
+            handled = bool(WKWebView.WKWebView.handlesURLScheme_(scheme))
+            WKWebView._handled_schemes[scheme] = handled
+        return handled
+
+    @property
+    def navigation_rules(self):
+        return self._navigation_rules
+
+    @navigation_rules.setter
+    def navigation_rules(self, value):
+        self.set_navigation_rules(value).add_done_callback(
+            self._content_rules_installed)
+
+    def _content_rules_installed(self, future):
+        # Nobody waits on the future when rules are assigned, so report
+        # compile errors like other errors in the background
+        error = future.exception()
+        if error is not None:
+            self._message({'level': 'error', 'content': str(error)})
+
+    def set_navigation_rules(self, rules, block_content=True):
+        """ Sets the NavigationRules that decide navigations before the
+        delegate is asked. With `block_content`, the deny rules are also
+        compiled into a WebKit content rule list that blocks matching loads,
+        including images, scripts and other resources of the page.
+
+        Raises ValueError if a url rule uses regex syntax that WebKit
+        content blockers do not support. Returns a future that is done when
+        the content rule list is in effect, with an exception if WebKit
+        could not compile it. """
+        encoded = rules.content_rules() \
+            if rules is not None and block_content else None
+        self._navigation_rules = rules
+        future = concurrent.futures.Future()
+        self._install_content_rules(encoded, future)
+        return future
+
+    @on_main_thread
+    def _install_content_rules(self, encoded, future):
+        controller = self.user_content_controller
+        controller.removeAllContentRuleLists()
+        if encoded is None:
+            self._content_rules_id = None
+            future.set_result(None)
+            return
+        # Compiled lists are persisted by WebKit, so the same rules are
+        # only compiled once, even across app launches
+        identifier = 'pythonista-' + WKWebView._content_key(encoded)[:16]
+        self._content_rules_id = identifier
+
+        def compiled(rule_list, error):
+            if not rule_list:
+                future.set_exception(ValueError(
+                    'Could not compile content rules: ' +
+                    str(ObjCInstance(error).localizedDescription())))
+                return
+            rule_list = ObjCInstance(rule_list)
+            WKWebView._content_rule_lists[identifier] = rule_list
+            if self._content_rules_id == identifier:
+                controller.addContentRuleList_(rule_list)
+            future.set_result(rule_list)
+
+        def looked_up(rule_list, error):
+            if rule_list:
+                compiled(rule_list, None)
+            else:
+                store.compileContentRuleListForIdentifier_encodedContentRuleList_completionHandler_(
+                    identifier, encoded,
+                    _completion_block(compiled, c_void_p, c_void_p))
+
+        rule_list = WKWebView._content_rule_lists.get(identifier)
+        if rule_list is not None:
+            controller.addContentRuleList_(rule_list)
+            future.set_result(rule_list)
+            return
+        store = WKWebView.WKContentRuleListStore.defaultStore()
+        store.lookUpContentRuleListForIdentifier_completionHandler_(
+            identifier, _completion_block(looked_up, c_void_p, c_void_p))
+
+    @classmethod
+    def _handler_names(cls):
+        # Names of the on_ handler methods, looked up once per class
+        names = cls.__dict__.get('_message_handler_names')
+        if names is None:
+            names = tuple(
+                key[3:] for key in dir(cls)
+                if key.startswith('on_') and callable(getattr(cls, key)))
+            cls._message_handler_names = names
+        return names
+
+    @on_main_thread
+    def add_message_handler(self, name, handler,
+            coalesce=None, max_pending=None):
+        """ Adds or replaces the handler for messages sent from javascript
+        with `window.webkit.messageHandlers.<name>.postMessage` or
+        `pythonista.post`. `handler` is called with one message argument.
+
+        Options default to the ones set with the `message_options`
+        decorator, if any.
+        """
+        options = dict(getattr(handler, 'message_options', {}))
+        if coalesce is not None:
+            options['coalesce'] = coalesce
+        if max_pending is not None:
+            options['max_pending'] = max_pending
+        registered = name in self._message_handlers
+        self._message_handlers[name] = message_handler = _MessageHandler(
+            handler, self.message_executor,
+            metrics=self._metrics, name=name, **options)
+        if not registered:
+            self.user_content_controller.addScriptMessageHandler_name_(
+                self._script_message_handler, name)
+        self._update_message_script()
+        self.eval_js_async(
+            f'if (window.pythonista) {{ pythonista.latest[{json.dumps(name)}]'
+            f' = {json.dumps(message_handler.coalesce)}; }}')
+
+    @on_main_thread
+    def remove_message_handler(self, name):
+        """ Removes the handler for the named messages, whether added with
+        `add_message_handler` or defined as an `on_` method. """
+        if self._message_handlers.pop(name, None) is not None:
+            self.user_content_controller.\
+                removeScriptMessageHandlerForName_(name)
+            self._update_message_script()
+
+    def _update_message_script(self):
+        self._internal_scripts['messages'] = self._message_script()
+        self._install_user_scripts()
 
     @on_main_thread
     def _create_webview(self, webview_config, nav_delegate, ui_delegate):
@@ -126,15 +1266,139 @@ class WKWebView(ui.View):
         self.webview.setUIDelegate_(ui_delegate)
         self.objc_instance.addSubview_(self.webview)
 
+    def will_close(self):
+        if self._pool is not None:
+            self._pool.release(self)
+
+    def close(self):
+        """ Closes the view like `ui.View.close`.
+
+        A view acquired from a `WKWebViewPool` is reset and returned to the
+        pool. Any other view releases what it holds in WebKit: message
+        handlers, user scripts, content rules and delegates, and pending
+        evaluations and loads are cancelled. It can not be used after this.
+
+        Safe to call more than once, and called when exiting a `with` block
+        on the view.
+        """
+        if self._closed:
+            return
+        if self._pool is not None:
+            super().close()
+            # Not presented, so will_close was not called
+            if self._pool is not None:
+                self._pool.release(self)
+            return
+        self._closed = True
+        super().close()
+        self.cancel_eval_js()
+        self.clear_eval_js_cache()
+        for handle in list(self._navigations.values()):
+            handle.cancel()
+        self._incoming.clear()
+        self._observers.clear()
+        self._exposed.clear()
+        self._scheme_tasks.clear()
+        self._teardown_webview()
+        self._release_retained()
+
+    @property
+    def closed(self):
+        """ True after `close` has been called. """
+        return self._closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def live_count(cls):
+        """ Number of WKWebViews that have not been garbage collected yet.
+        With `retained_count`, can be used to check for leaks, after
+        `gc.collect()`. """
+        return len(WKWebView.webviews)
+
+    @classmethod
+    def _open_webviews(cls):
+        return {index: webview
+            for index, webview in list(WKWebView.webviews.items())
+            if not webview.closed}
+
+    @staticmethod
+    def _release_tokens(tokens):
+        for token in tokens:
+            _retained.release(token)
+        tokens.clear()
+
+    @on_main_thread
+    def _teardown_webview(self):
+        self.webview.stopLoading()
+        controller = self.user_content_controller
+        for name in list(self._message_handlers) + [
+                WKWebView._batch_channel, WKWebView._data_channel,
+                WKWebView._call_channel, WKWebView._dom_channel,
+                WKWebView._observe_channel]:
+            controller.removeScriptMessageHandlerForName_(name)
+        self._message_handlers.clear()
+        controller.removeAllUserScripts()
+        controller.removeAllContentRuleLists()
+        self.webview.setNavigationDelegate_(None)
+        self.webview.setUIDelegate_(None)
+        self.webview.removeFromSuperview()
+        if self.superview is not None:
+            self.superview.remove_subview(self)
+
+    @on_main_thread
+    def _reset_for_reuse(self):
+        # Everything the previous user could have set on the view goes back
+        # to how the constructor left it
+        self.cancel_eval_js()
+        self.clear_eval_js_cache()
+        self.webview.stopLoading()
+        if self.superview is not None:
+            self.superview.remove_subview(self)
+        self.delegate = None
+        self._console_log.clear()
+        self._message_subscribers = []
+        self._reset_message_handlers()
+        self._exposed.clear()
+        self._observers.clear()
+        self._incoming.clear()
+        self._internal_scripts['observe'] = WKWebView.js_observe_script
+        self.clear_scripts()
+        self.set_navigation_rules(None)
+        self.scroll_enabled = True
+        self.swipe_navigation = self._default_swipe_navigation
+        self.webview.setCustomUserAgent_(None)
+        self.webview.loadHTMLString_baseURL_('', None)
+
+    def _reset_message_handlers(self):
+        # Back to the `on_` methods of the class
+        names = type(self)._handler_names()
+        for name in list(self._message_handlers):
+            if name not in names:
+                self.remove_message_handler(name)
+        for name in names:
+            handler = getattr(self, 'on_' + name)
+            current = self._message_handlers.get(name)
+            if current is None or current.func != handler or \
+                    current.executor is not self.message_executor:
+                self.add_message_handler(name, handler)
+
     def layout(self):
         if self.respect_safe_areas:
             self.update_safe_area_insets()
 
-    @on_main_thread
-    def load_url(self, url, no_cache=False, timeout=10):
+    def load_url(self, url, no_cache=False, timeout=10, until='finish'):
         """ Loads the contents of the given url
         asynchronously.
 
+        Returns a `NavigationHandle` that completes when the page has
+        finished loading, or with `until='dom'` already when the page
+        fires `DOMContentLoaded`.
+
         If the url starts with `file://`, loads a local file. If the remaining
         url starts with `/`, path starts from Pythonista root.
 
@@ -144,6 +1408,12 @@ class WKWebView(ui.View):
           * Set `no_cache` to `True` to skip the local cache, default is `False`
           * Set `timeout` to a specific timeout value, default is 10 (seconds)
         """
+        # Checked in the calling thread, before anything is loaded
+        WKWebView._check_until(until)
+        return self._load_url(url, no_cache, timeout, until)
+
+    @on_main_thread
+    def _load_url(self, url, no_cache, timeout, until):
         if url.startswith('file://'):
             file_path = url[7:]
             if file_path.startswith('/'):
@@ -155,101 +1425,680 @@ class WKWebView(ui.View):
             dir_only = os.path.dirname(file_path)
             file_path = NSURL.fileURLWithPath_(file_path)
             dir_only = NSURL.fileURLWithPath_(dir_only)
-            self.webview.loadFileURL_allowingReadAccessToURL_(
+            navigation = self.webview.loadFileURL_allowingReadAccessToURL_(
                 file_path, dir_only)
         else:
             cache_policy = 1 if no_cache else 0
-            self.webview.loadRequest_(
+            navigation = self.webview.loadRequest_(
                 WKWebView.NSURLRequest.
                     requestWithURL_cachePolicy_timeoutInterval_(
                         nsurl(url),
                         cache_policy,
                         timeout))
+        return self._navigation_handle(navigation, until)
+
+    def load_html(self, html, until='finish'):
+        """ Loads the given html string, and returns a `NavigationHandle`
+        like `load_url`. """
+        WKWebView._check_until(until)
+        return self._load_html(html, until)
 
     @on_main_thread
-    def load_html(self, html):
+    def _load_html(self, html, until):
         # Need to set a base directory to get
         # real js errors
         current_working_directory = os.path.dirname(os.getcwd())
         root_dir = NSURL.fileURLWithPath_(current_working_directory)
-        self.webview.loadHTMLString_baseURL_(html, root_dir)
+        navigation = self.webview.loadHTMLString_baseURL_(html, root_dir)
+        return self._navigation_handle(navigation, until)
+
+    async def load_url_aio(self, url, no_cache=False, timeout=10,
+            until='finish'):
+        """ Awaitable version of `load_url`, completes when the page has
+        finished loading, or raises `NavigationError` if loading fails. """
+        return await self.load_url(url, no_cache, timeout, until)
+
+    async def load_html_aio(self, html, until='finish'):
+        """ Awaitable version of `load_html`. """
+        return await self.load_html(html, until)
+
+    @staticmethod
+    def _check_until(until):
+        if until not in ('finish', 'dom'):
+            raise ValueError(f'Unknown navigation stage: {until}')
+
+    def _navigation_handle(self, navigation, until):
+        # Registered on the main thread, before any of the navigation
+        # delegate callbacks for the navigation can run. Handles are only
+        # weakly referenced, so unused ones cost nothing.
+        handle = NavigationHandle(navigation, until)
+        if navigation:
+            self._navigations[_objc_key(navigation)] = handle
+        else:
+            handle.set_result(None)
+        return handle
+
+    def _navigation_finished(self, navigation, error=None):
+        handle = self._navigations.pop(_objc_key(navigation), None)
+        if handle is None or handle.done():
+            return False
+        if not handle.set_running_or_notify_cancel():
+            return False
+        if error is None:
+            handle.set_result(str(self.webview.URL()))
+        else:
+            handle.set_exception(error)
+        return True
+
+    def _dom_ready(self):
+        handle = self._navigations.get(self._committed_navigation)
+        if handle is not None and handle.until == 'dom':
+            self._navigation_finished(self._committed_navigation)
 
-    def eval_js(self, js):
-        self.eval_js_async(js, self._eval_js_sync_callback)
-        value = self.eval_js_queue.get()
-        return value
+    def eval_js(self, js, timeout=None, value_format=None, cache=False):
+        """ Evaluates the given javascript and waits for the result.
+
+        Must be called outside the main thread. Each call waits on its own
+        future, so several threads can evaluate against the same view at
+        the same time.
+
+        If `timeout` (or the `eval_js_timeout` given to the constructor) is
+        set and the evaluation does not complete in time, the evaluation is
+        cancelled and `concurrent.futures.TimeoutError` is raised.
+
+        `value_format` overrides the `value_format` of the view for this call.
+
+        With `cache=True`, the result is remembered until the next page
+        starts loading, and repeated calls with the same javascript return
+        it without evaluating again. A number of seconds as `cache` also
+        limits how long the result is remembered.
+        """
+        future = self.eval_js_future(js, value_format, cache)
+        if timeout is None:
+            timeout = self.eval_js_timeout
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
 
     evaluate_javascript = eval_js
 
-    @on_main_thread
-    def _eval_js_sync_callback(self, value):
-        self.eval_js_queue.put(value)
+    def eval_js_future(self, js, value_format=None, cache=False):
+        """ Starts evaluating the given javascript and returns a
+        `concurrent.futures.Future` for the result.
+
+        Cancelling the future makes the view ignore the result when it
+        eventually arrives. Safe to call from any thread, including the
+        main thread, as long as you do not wait on the result there.
+        `cache` works like with `eval_js`.
+        """
+        future = concurrent.futures.Future()
+        value_format = value_format or self.value_format
+        callback = None
+        if cache:
+            key = (js, value_format)
+            found, value = self._cached_eval_js(key)
+            if found:
+                future.set_result(value)
+                return future
+            callback = functools.partial(self._cache_eval_js,
+                key, cache, self._eval_js_cache_generation)
+        call_id = next(self._eval_js_ids)
+        self._eval_js_futures[call_id] = future
+        future.add_done_callback(
+            lambda f: self._eval_js_futures.pop(call_id, None))
+        resolve = functools.partial(self._resolve_eval_js, call_id)
+        if callback is not None:
+            resolve = functools.partial(callback, resolve)
+        self.eval_js_async(js, resolve, value_format)
+        return future
+
+    def _resolve_eval_js(self, call_id, value):
+        future = self._eval_js_futures.pop(call_id, None)
+        if future is not None and future.set_running_or_notify_cancel():
+            future.set_result(value)
+
+    async def eval_js_aio(self, js, value_format=None, cache=False):
+        """ Awaitable version of `eval_js`, usable from an asyncio event
+        loop running in any thread. """
+        return await asyncio.wrap_future(
+            self.eval_js_future(js, value_format, cache))
+
+    def clear_eval_js_cache(self):
+        """ Forgets the results cached with `eval_js(..., cache=True)`.
+        Called automatically when a new page starts loading. """
+        with self._eval_js_cache_lock:
+            self._eval_js_cache.clear()
+            # Results of evaluations still in flight belong to the old page
+            self._eval_js_cache_generation += 1
+
+    def _cached_eval_js(self, key):
+        with self._eval_js_cache_lock:
+            entry = self._eval_js_cache.get(key)
+            if entry is None:
+                return False, None
+            value, expires = entry
+            if expires is not None and time.monotonic() >= expires:
+                del self._eval_js_cache[key]
+                return False, None
+            self._eval_js_cache.move_to_end(key)
+        if self._metrics is not None:
+            self._metrics.count('eval_js.cached')
+        return True, value
+
+    def _cache_eval_js(self, key, ttl, generation, resolve, value):
+        # None is also the result of a failed evaluation, never cache it
+        if value is not None:
+            expires = None if ttl is True else time.monotonic() + ttl
+            with self._eval_js_cache_lock:
+                if generation == self._eval_js_cache_generation:
+                    self._eval_js_cache[key] = (value, expires)
+                    self._eval_js_cache.move_to_end(key)
+                    while len(self._eval_js_cache) > self.eval_js_cache_size:
+                        self._eval_js_cache.popitem(last=False)
+        resolve(value)
+
+    def eval_js_many(self, expressions, timeout=None):
+        """ Evaluates a list of javascript expressions in a single round
+        trip and waits for the results.
+
+        Returns a list with one item per expression, in input order. The item
+        is the JSON-compatible value of the expression, or a `JavascriptError`
+        instance if evaluating that expression threw. Like `eval_js`, must be
+        called outside the main thread.
+        """
+        expressions = list(expressions)
+        result = self.eval_js(self._batch_js(expressions), timeout, 'str')
+        return self._parse_batch_result(result, len(expressions))
+
+    eval_js_batch = eval_js_many
+
+    def eval_js_many_async(self, expressions, callback=None):
+        """ Asynchronous version of `eval_js_many`, calls the optional
+        `callback` with the list of results. """
+        expressions = list(expressions)
+        def batch_callback(result):
+            results = WKWebView._parse_batch_result(result, len(expressions))
+            if callback:
+                callback(results)
+        self.eval_js_async(
+            self._batch_js(expressions), batch_callback, 'str')
+
+    @staticmethod
+    def _batch_js(expressions):
+        evaluations = ''.join(
+            'try{r.push([0,(' + expression + '\n)])}'
+            'catch(e){r.push([1,String(e)])}'
+            for expression in expressions)
+        return (
+            '(function(){var r=[];' + evaluations +
+            'try{return JSON.stringify(r)}catch(e){'
+            'return JSON.stringify(r.map(function(x){'
+            'try{JSON.stringify(x[1]);return x}'
+            'catch(e){return [x[0],String(x[1])]}}))}})()')
+
+    @staticmethod
+    def _parse_batch_result(result, count):
+        if result is None:
+            # Typically a syntax error in one of the expressions, which
+            # prevents the whole batch from running
+            return [JavascriptError('Batch evaluation failed')] * count
+        return [
+            JavascriptError(value) if failed else value
+            for failed, value in json.loads(result)
+        ]
+
+    def cancel_eval_js(self):
+        """ Cancels all javascript evaluations that are still waiting for
+        a result. """
+        for future in list(self._eval_js_futures.values()):
+            future.cancel()
 
     @on_main_thread
-    def eval_js_async(self, js, callback=None):
+    def eval_js_async(self, js, callback=None, value_format=None):
         if self.log_js_evals:
-            self.console.message({'level': 'code', 'content': js})
-        handler = functools.partial(
-            WKWebView._handle_completion, callback, self)
+            self._message({'level': 'code', 'content': js})
+        value_format = value_format or self.value_format
+        if value_format == 'json':
+            js = 'JSON.stringify((' + js + '\n))'
+        token = _retained.token()
+        started = time.perf_counter() if self._metrics is not None else None
+        handler = functools.partial(WKWebView._handle_completion,
+            callback, self, token, value_format, started)
         block = ObjCBlock(
             handler, restype=None, argtypes=[c_void_p, c_void_p, c_void_p])
-        retain_global(block)
+        _retained.retain(block, token)
         self.webview.evaluateJavaScript_completionHandler_(js, block)
 
+    @classmethod
+    def retained_count(cls):
+        """ Number of ObjC blocks, handlers and delegates currently kept
+        alive by all WKWebViews. Stays flat in a steady state, and can be
+        used to check for leaks. """
+        return len(_retained)
+
     def clear_cache(self, completion_handler=None):
-        store = WKWebView.WKWebsiteDataStore.defaultDataStore()
-        data_types = WKWebView.WKWebsiteDataStore.allWebsiteDataTypes()
-        from_start = WKWebView.NSDate.dateWithTimeIntervalSince1970_(0)
-        def dummy_completion_handler():
-            pass
-        store.removeDataOfTypes_modifiedSince_completionHandler_(
-            data_types, from_start,
-            completion_handler or dummy_completion_handler)
+        """ Removes all website data of the view's data store, see
+        `remove_website_data`. Calls the optional `completion_handler`
+        without arguments when done, and returns a future. """
+        future = self.remove_website_data()
+        if completion_handler is not None:
+            future.add_done_callback(lambda f: completion_handler())
+        return future
+
+    # Website data
+
+    # Short names for the WKWebsiteDataType constants
+    WEBSITE_DATA_TYPES = {
+        'disk_cache': 'WKWebsiteDataTypeDiskCache',
+        'memory_cache': 'WKWebsiteDataTypeMemoryCache',
+        'offline_cache': 'WKWebsiteDataTypeOfflineWebApplicationCache',
+        'fetch_cache': 'WKWebsiteDataTypeFetchCache',
+        'cookies': 'WKWebsiteDataTypeCookies',
+        'session_storage': 'WKWebsiteDataTypeSessionStorage',
+        'local_storage': 'WKWebsiteDataTypeLocalStorage',
+        'websql': 'WKWebsiteDataTypeWebSQLDatabases',
+        'indexeddb': 'WKWebsiteDataTypeIndexedDBDatabases',
+        'service_workers': 'WKWebsiteDataTypeServiceWorkerRegistrations',
+    }
+    _website_data_type_names = {
+        value: key for key, value in WEBSITE_DATA_TYPES.items()}
+
+    def website_data(self, types=None):
+        """ Returns a future for the website data records of the view's data
+        store, one per site, each with the `name` of the site (usually its
+        domain) and the set of data `types` stored for it.
+
+        `types` limits the records to the given `WEBSITE_DATA_TYPES`. Like
+        the other website data methods, do not wait for the result in the
+        main thread.
+        """
+        future = concurrent.futures.Future()
+        self._fetch_data_records(types, future, lambda records:
+            future.set_result([
+                WKWebView._data_record(record) for record in records]))
+        return future
+
+    def remove_website_data(self, types=None, domains=None, since=None):
+        """ Removes website data from the view's data store, and returns a
+        future that is done when the data is gone.
+
+        Removes everything by default. `types` limits the removal to the
+        given `WEBSITE_DATA_TYPES`, `domains` to the sites of the given
+        domains, their subdomains and parent domains, and `since` to data
+        modified after the given `datetime` or timestamp. WebKit can not
+        combine `domains` and `since`.
+        """
+        if domains is not None and since is not None:
+            raise ValueError('domains and since can not be combined')
+        future = concurrent.futures.Future()
+        if domains is None:
+            if since is None:
+                since = 0
+            elif hasattr(since, 'timestamp'):
+                since = since.timestamp()
+            self._remove_data_since(types, since, future)
+            return future
+        domains = WKWebView._domains(domains)
+        self._fetch_data_records(types, future, lambda records:
+            self._remove_data_records(types, [
+                record for record in records
+                if WKWebView._matches_domain(
+                    str(record.displayName()), domains)
+            ], future))
+        return future
+
+    def get_cookies(self, domain=None):
+        """ Returns a future for the cookies of the view's data store,
+        optionally only the ones that apply to `domain` or its subdomains.
+
+        Cookies are dicts with `name`, `value`, `domain`, `path`, `expires`
+        (a timestamp, or None for session cookies), `secure` and `http_only`
+        items, and can be saved as JSON and restored with `set_cookies`.
+        """
+        future = concurrent.futures.Future()
+        domains = None if domain is None else WKWebView._domains(domain)
+        self._fetch_cookies(future, lambda cookies: future.set_result([
+            WKWebView._cookie_dict(cookie) for cookie in cookies
+            if domains is None or WKWebView._matches_domain(
+                str(cookie.domain()), domains)]))
+        return future
+
+    def set_cookies(self, cookies):
+        """ Adds or replaces cookies given as dicts like the ones returned
+        by `get_cookies`. `name`, `value` and `domain` are required. Returns
+        a future that is done when all the cookies are set. """
+        future = concurrent.futures.Future()
+        self._set_cookies(list(cookies), future)
+        return future
+
+    def delete_cookies(self, domain=None):
+        """ Deletes the cookies of the view's data store, optionally only
+        the ones that apply to `domain` or its subdomains. Returns a future
+        for the number of deleted cookies. """
+        future = concurrent.futures.Future()
+        domains = None if domain is None else WKWebView._domains(domain)
+        self._fetch_cookies(future, lambda cookies: self._delete_cookies([
+            cookie for cookie in cookies
+            if domains is None or WKWebView._matches_domain(
+                str(cookie.domain()), domains)
+        ], future))
+        return future
+
+    @staticmethod
+    def _data_record(record):
+        return SimpleNamespace(
+            name=str(record.displayName()),
+            types={
+                WKWebView._website_data_type_names.get(name, name)
+                for name in objc_to_python(record.dataTypes().allObjects())})
+
+    @staticmethod
+    def _domains(domains):
+        if isinstance(domains, str):
+            domains = [domains]
+        return tuple(domain.lstrip('.').lower() for domain in domains)
+
+    @staticmethod
+    def _matches_domain(name, domains):
+        # Sites and cookies of the domain itself, its subdomains, and the
+        # parent domains that also apply to it
+        name = name.lstrip('.').lower()
+        return any(
+            name == domain or name.endswith('.' + domain) or
+            domain.endswith('.' + name)
+            for domain in domains)
+
+    @staticmethod
+    def _data_types(types):
+        if types is None:
+            return WKWebView.WKWebsiteDataStore.allWebsiteDataTypes()
+        if isinstance(types, str):
+            types = [types]
+        names = []
+        for name in types:
+            name = WKWebView.WEBSITE_DATA_TYPES.get(name, name)
+            if name not in WKWebView._website_data_type_names and \
+                    not name.startswith('WKWebsiteDataType'):
+                raise ValueError(f'Unknown website data type: {name}')
+            names.append(name)
+        return WKWebView.NSSet.setWithArray_(ns(names))
+
+    @staticmethod
+    def _objc_list(array):
+        array = ObjCInstance(array)
+        return [array.objectAtIndex_(i) for i in range(array.count())]
+
+    @staticmethod
+    def _resolving(future, callback):
+        # Completion block callback that fails the future if `callback`
+        # raises, instead of letting the exception escape into ObjC
+        def resolve(*args):
+            try:
+                callback(*args)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+        return resolve
+
+    @on_main_thread
+    def _fetch_data_records(self, types, future, callback):
+        self._data_store.fetchDataRecordsOfTypes_completionHandler_(
+            WKWebView._data_types(types), _completion_block(
+                WKWebView._resolving(future, lambda records:
+                    callback(WKWebView._objc_list(records))),
+                c_void_p))
+
+    @on_main_thread
+    def _remove_data_since(self, types, since, future):
+        self._data_store.removeDataOfTypes_modifiedSince_completionHandler_(
+            WKWebView._data_types(types),
+            WKWebView.NSDate.dateWithTimeIntervalSince1970_(since),
+            _completion_block(lambda: future.set_result(None)))
+
+    @on_main_thread
+    def _remove_data_records(self, types, records, future):
+        if not records:
+            future.set_result(None)
+            return
+        self._data_store.removeDataOfTypes_forDataRecords_completionHandler_(
+            WKWebView._data_types(types), ns(records),
+            _completion_block(lambda: future.set_result(None)))
+
+    @on_main_thread
+    def _fetch_cookies(self, future, callback):
+        self._data_store.httpCookieStore().getAllCookies_(_completion_block(
+            WKWebView._resolving(future, lambda cookies:
+                callback(WKWebView._objc_list(cookies))),
+            c_void_p))
+
+    @on_main_thread
+    def _set_cookies(self, cookies, future):
+        try:
+            cookies = [WKWebView._objc_cookie(cookie) for cookie in cookies]
+        except (KeyError, ValueError) as e:
+            future.set_exception(e)
+            return
+        self._each_cookie('setCookie_completionHandler_', cookies, future,
+            None)
+
+    @on_main_thread
+    def _delete_cookies(self, cookies, future):
+        self._each_cookie('deleteCookie_completionHandler_', cookies, future,
+            len(cookies))
+
+    def _each_cookie(self, method, cookies, future, result):
+        # Calls the cookie store method for every cookie, and completes the
+        # future after the last completion handler
+        if not cookies:
+            future.set_result(result)
+            return
+        remaining = [len(cookies)]
+        def done():
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                future.set_result(result)
+        call = getattr(self._data_store.httpCookieStore(), method)
+        for cookie in cookies:
+            call(cookie, _completion_block(done))
+
+    @staticmethod
+    def _cookie_dict(cookie):
+        expires = cookie.expiresDate()
+        return {
+            'name': str(cookie.name()),
+            'value': str(cookie.value()),
+            'domain': str(cookie.domain()),
+            'path': str(cookie.path()),
+            'expires': float(expires.timeIntervalSince1970())
+                if expires else None,
+            'secure': bool(cookie.isSecure()),
+            'http_only': bool(cookie.isHTTPOnly()),
+        }
+
+    @staticmethod
+    def _objc_cookie(cookie):
+        properties = {
+            'Name': cookie['name'],
+            'Value': cookie['value'],
+            'Domain': cookie['domain'],
+            'Path': cookie.get('path') or '/',
+        }
+        if cookie.get('expires') is not None:
+            properties['Expires'] = WKWebView.NSDate.\
+                dateWithTimeIntervalSince1970_(cookie['expires'])
+        if cookie.get('secure'):
+            properties['Secure'] = 'TRUE'
+        if cookie.get('http_only'):
+            properties['HttpOnly'] = 'TRUE'
+        objc_cookie = WKWebView.NSHTTPCookie.cookieWithProperties_(
+            ns(properties))
+        if not objc_cookie:
+            raise ValueError(f'Invalid cookie: {cookie}')
+        return objc_cookie
 
     # Javascript evaluation completion handler
 
-    def _handle_completion(callback, webview, _cmd, _obj, _err):
-        result = str(ObjCInstance(_obj)) if _obj else None
-        if webview.log_js_evals:
-            webview._message({'level': 'raw', 'content': str(result)})
-        if callback:
-            callback(result)
+    def _handle_completion(
+            callback, webview, token, value_format, started,
+            _cmd, _obj, _err):
+        try:
+            if started is not None:
+                webview._metrics.observe(
+                    'eval_js', time.perf_counter() - started)
+                if _err:
+                    webview._metrics.count('eval_js.errors')
+            result = WKWebView._convert_value(_obj, value_format)
+            if webview.log_js_evals:
+                webview._message({'level': 'raw', 'content': str(result)})
+            if callback:
+                callback(result)
+        finally:
+            _retained.release(token)
+
+    @staticmethod
+    def _convert_value(obj, value_format):
+        if not obj:
+            return None
+        if value_format == 'native':
+            return objc_to_python(obj)
+        if value_format == 'json':
+            value = objc_to_python(obj)
+            if isinstance(value, str):
+                try:
+                    return json.loads(value)
+                except ValueError:
+                    pass
+            return value
+        return str(ObjCInstance(obj))
 
     def add_script(self, js_script, add_to_end=True):
-        location = 1 if add_to_end else 0
-        wk_script = WKWebView.WKUserScript.alloc().\
-            initWithSource_injectionTime_forMainFrameOnly_(
-                js_script, location, False)
-        self.user_content_controller.addUserScript_(wk_script)
+        """
+        Adds a javascript script that is run on every page loaded by the view,
+        at the end of the document (default) or at the start of the document.
+        Adding the same script again has no effect.
+        """
+        scripts = self._user_scripts[1 if add_to_end else 0]
+        key = self._content_key(js_script)
+        if key not in scripts:
+            scripts[key] = js_script
+            self._install_user_scripts()
+
+    def remove_script(self, js_script):
+        """
+        Removes a script added earlier with `add_script`.
+        """
+        key = self._content_key(js_script)
+        found = [scripts.pop(key, None) for scripts in self._user_scripts]
+        if any(found):
+            self._install_user_scripts()
 
     def add_style(self, css):
         """
         Convenience method to add a style tag with the given css, to every
         page loaded by the view.
         """
-        css = css.replace("'", "\'")
-        js = f"var style = document.createElement('style');"
-        "style.innerHTML = '{css}';"
-        "document.getElementsByTagName('head')[0].appendChild(style);"
-        self.add_script(js, add_to_end=True)
+        key = self._content_key(css)
+        if key not in self._user_styles:
+            self._user_styles[key] = css
+            self._install_user_scripts()
+
+    def remove_style(self, css):
+        """
+        Removes css added earlier with `add_style`.
+        """
+        if self._user_styles.pop(self._content_key(css), None) is not None:
+            self._install_user_scripts()
 
     def add_meta(self, name, content):
         """
         Convenience method to add a meta tag with the given name and content,
-        to every page loaded by the view."
+        to every page loaded by the view. Replaces an earlier meta tag with
+        the same name.
+        """
+        if self._user_metas.get(name) != content:
+            self._user_metas[name] = content
+            self._install_user_scripts()
+
+    def remove_meta(self, name):
+        """
+        Removes the meta tag with the given name added with `add_meta`.
+        """
+        if self._user_metas.pop(name, None) is not None:
+            self._install_user_scripts()
+
+    def clear_scripts(self):
+        """
+        Removes all scripts, styles and meta tags added with the methods
+        above.
         """
-        name = name.replace("'", "\'")
-        content = content.replace("'", "\'")
-        js = f"var meta = document.createElement('meta');"
-        "meta.setAttribute('name', '{name}');"
-        "meta.setAttribute('content', '{content}');"
-        "document.getElementsByTagName('head')[0].appendChild(meta);"
-        self.add_script(js, add_to_end=True)
+        for scripts in self._user_scripts:
+            scripts.clear()
+        self._user_styles.clear()
+        self._user_metas.clear()
+        self._install_user_scripts()
+
+    @staticmethod
+    def _content_key(content):
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _bundle_scripts(scripts):
+        # Each script is guarded separately, so that an exception in one
+        # does not prevent the others from running. Only used for our own
+        # scripts, as the try block makes top-level declarations local.
+        return '\n'.join(
+            'try {\n' + script + '\n} catch (e) { console.error(e); }'
+            for script in scripts)
+
+    def _user_script_bundles(self):
+        # Internal scripts, styles and meta tags are bundled, user scripts
+        # are installed as they are, so that their top-level let, const
+        # and class declarations stay visible to the page
+        start = [self._bundle_scripts(self._internal_scripts.values())]
+        start.extend(self._user_scripts[0].values())
+        end = []
+        if self._user_styles:
+            end.append(
+                "var style = document.createElement('style');\n"
+                'style.textContent = ' +
+                json.dumps('\n'.join(self._user_styles.values())) + ';\n'
+                '(document.head || document.documentElement)'
+                '.appendChild(style);')
+        if self._user_metas:
+            end.append(
+                json.dumps(list(self._user_metas.items())) +
+                '.forEach(function(m) {\n'
+                " var meta = document.createElement('meta');\n"
+                " meta.setAttribute('name', m[0]);\n"
+                " meta.setAttribute('content', m[1]);\n"
+                ' (document.head || document.documentElement)'
+                '.appendChild(meta);\n'
+                '});')
+        end = [self._bundle_scripts(end)] if end else []
+        end.extend(self._user_scripts[1].values())
+        return tuple(start), tuple(end)
+
+    @on_main_thread
+    def _install_user_scripts(self):
+        bundles = self._user_script_bundles()
+        if bundles == self._installed_bundles:
+            return
+        self._installed_bundles = bundles
+        controller = self.user_content_controller
+        controller.removeAllUserScripts()
+        for location, sources in enumerate(bundles):
+            for source in sources:
+                wk_script = WKWebView.WKUserScript.alloc().\
+                    initWithSource_injectionTime_forMainFrameOnly_(
+                        source, location, False).autorelease()
+                controller.addUserScript_(wk_script)
 
     def disable_zoom(self):
         name = 'viewport'
-        content = 'width=device-width, initial-scale=1.0,'
-        'maximum-scale=1.0, user-scalable=no'
+        content = ('width=device-width, initial-scale=1.0, '
+            'maximum-scale=1.0, user-scalable=no')
         self.add_meta(name, content)
 
     def disable_user_selection(self):
@@ -280,7 +2129,7 @@ class WKWebView(ui.View):
     @property
     def user_agent(self):
         "Must be called outside main thread"
-        return self.eval_js('navigator.userAgent')
+        return self.eval_js('navigator.userAgent', cache=True)
 
     @on_main_thread
     def _get_user_agent2(self):
@@ -290,6 +2139,7 @@ class WKWebView(ui.View):
     def user_agent(self, value):
         value = str(value)
         self._set_user_agent(value)
+        self.clear_eval_js_cache()
 
     @on_main_thread
     def _set_user_agent(self, value):
@@ -347,6 +2197,749 @@ class WKWebView(ui.View):
         self.frame = self.frame.inset(
             insets.top, insets.left, insets.bottom, insets.right)
 
+    async def messages_aio(self, *names):
+        """ Asynchronous iterator over the messages sent from javascript to
+        the `on_` handlers of this view, as `(name, message)` tuples.
+
+        Give one or more handler names to only receive messages for those.
+        The messages are still passed to the handlers as well.
+        """
+        loop = asyncio.get_event_loop()
+        messages = asyncio.Queue()
+        subscriber = (loop, messages, frozenset(names))
+        self._message_subscribers.append(subscriber)
+        try:
+            while True:
+                yield await messages.get()
+        finally:
+            # Gone if the view was reset for reuse in a pool
+            if subscriber in self._message_subscribers:
+                self._message_subscribers.remove(subscriber)
+
+    js_message_script = '''(function() {
+    var p = window.pythonista;
+    var queue = [];
+    var latestIndex = {};
+    var scheduled = false;
+    function flush() {
+     scheduled = false;
+     if (queue.length === 0) { return; }
+     var batch = queue;
+     queue = [];
+     latestIndex = {};
+     window.webkit.messageHandlers._pythonista_batch.postMessage(
+      JSON.stringify(batch));
+    }
+    p.post = function(name, message) {
+     if (message === undefined) { message = null; }
+     if (p.latest[name]) {
+      if (name in latestIndex) {
+       queue[latestIndex[name]][1] = message;
+       return;
+      }
+      latestIndex[name] = queue.length;
+     }
+     queue.push([name, message]);
+     if (queue.length >= p.batchSize) {
+      flush();
+     } else if (!scheduled) {
+      scheduled = true;
+      window.requestAnimationFrame(flush);
+      setTimeout(flush, 100);
+     }
+    };
+    p.flush = flush;
+    window.addEventListener('pagehide', flush);
+    })();'''
+
+    _batch_channel = '_pythonista_batch'
+
+    def _message_script(self):
+        latest = {
+            name: True for name, handler in self._message_handlers.items()
+            if handler.coalesce
+        }
+        return (
+            'window.pythonista = window.pythonista || {};\n'
+            f'pythonista.batchSize = {int(self._message_batch_size)};\n'
+            f'pythonista.latest = {json.dumps(latest)};\n' +
+            WKWebView.js_message_script)
+
+    def _dispatch_message(self, name, content):
+        handler = self._message_handlers.get(name)
+        if handler is None:
+            raise Exception(
+                f'Unhandled message from script - name: {name}, '
+                f'content: {content}')
+        if self._metrics is not None:
+            self._count_messages(name, [content])
+        handler.deliver([content])
+        self._publish_message(name, content)
+
+    def _dispatch_batch(self, batch):
+        by_name = collections.OrderedDict()
+        for name, content in json.loads(batch):
+            if self.value_format == 'str' and not isinstance(content, str):
+                content = json.dumps(content)
+            by_name.setdefault(name, []).append(content)
+        for name, contents in by_name.items():
+            handler = self._message_handlers.get(name)
+            if handler is None:
+                raise Exception(
+                    f'Unhandled message from script - name: {name}')
+            if self._metrics is not None:
+                self._count_messages(name, contents)
+            handler.deliver(contents)
+            for content in contents:
+                self._publish_message(name, content)
+
+    def _publish_message(self, name, content):
+        for loop, messages, names in self._message_subscribers:
+            if not names or name in names:
+                loop.call_soon_threadsafe(
+                    messages.put_nowait, (name, content))
+
+    # Bulk data from Python to the page
+
+    js_data_script = '''(function() {
+    var p = window.pythonista;
+    var transfers = {};
+    var received = {};
+    var waiting = {};
+    var listeners = {};
+    function deliver(channel, value) {
+     var callbacks = listeners[channel] || [];
+     callbacks.forEach(function(callback) {
+      try { callback(value); } catch (e) { console.error(e); }
+     });
+     var resolvers = waiting[channel] || [];
+     if (resolvers.length) {
+      resolvers.shift()(value);
+     } else if (!callbacks.length) {
+      (received[channel] = received[channel] || []).push(value);
+     }
+    }
+    p.receive = function(channel) {
+     var values = received[channel];
+     if (values && values.length) {
+      return Promise.resolve(values.shift());
+     }
+     return new Promise(function(resolve) {
+      (waiting[channel] = waiting[channel] || []).push(resolve);
+     });
+    };
+    p.onData = function(channel, callback) {
+     (listeners[channel] = listeners[channel] || []).push(callback);
+    };
+    p._dataBegin = function(id, channel, kind, size) {
+     transfers[id] = {
+      channel: channel, kind: kind, offset: 0, parts: [],
+      buffer: size >= 0 ? new Uint8Array(size) : null};
+     return true;
+    };
+    p._dataChunk = function(id, chunk) {
+     var t = transfers[id];
+     if (!t) { return false; }
+     var s = atob(chunk);
+     var n = s.length;
+     var bytes = t.buffer ? t.buffer.subarray(t.offset, t.offset + n)
+      : new Uint8Array(n);
+     for (var i = 0; i < n; i++) { bytes[i] = s.charCodeAt(i); }
+     if (!t.buffer) { t.parts.push(bytes); }
+     t.offset += n;
+     return true;
+    };
+    p._dataEnd = function(id) {
+     var t = transfers[id];
+     if (!t) { return false; }
+     delete transfers[id];
+     var buffer = t.buffer;
+     if (!buffer) {
+      buffer = new Uint8Array(t.offset);
+      var offset = 0;
+      t.parts.forEach(function(part) {
+       buffer.set(part, offset);
+       offset += part.length;
+      });
+     }
+     var value = buffer.buffer;
+     if (t.kind !== 'bytes') {
+      value = new TextDecoder().decode(buffer);
+      if (t.kind === 'json') { value = JSON.parse(value); }
+     }
+     deliver(t.channel, value);
+     return true;
+    };
+    p._dataAbort = function(id) {
+     delete transfers[id];
+     return true;
+    };
+    })();'''
+
+    data_chunk_size = 256 * 1024
+    data_chunks_in_flight = 4
+    # Reads and encodes the chunks, one worker per active transfer
+    _data_executor = _lazy(
+        concurrent.futures.ThreadPoolExecutor, max_workers=4)
+
+    def send_data(self, channel, data, chunk_size=None):
+        """ Sends `data` to the page in chunks, where it is received with
+        `pythonista.receive(channel)` or `pythonista.onData(channel,
+        callback)`.
+
+        `bytes`, bytes-like objects and binary file objects arrive as an
+        ArrayBuffer, `str` as a string, and anything else is sent as JSON
+        and arrives parsed. Returns a future that is done when the page has
+        all of the data, and can be cancelled to stop the transfer. """
+        kind, size, chunks = self._data_chunks(
+            data, chunk_size or self.data_chunk_size)
+        transfer = SimpleNamespace(
+            id=next(self._transfer_ids),
+            chunks=chunks,
+            window=threading.Semaphore(self.data_chunks_in_flight),
+            in_flight=0,
+            finished=False,
+            future=concurrent.futures.Future())
+        transfer.window.acquire()
+        self._send_data_js(transfer,
+            f'pythonista._dataBegin({transfer.id}, {json.dumps(channel)}, '
+            f'"{kind}", {size})')
+        WKWebView._data_executor.submit(self._send_chunks, transfer)
+        return transfer.future
+
+    @staticmethod
+    def _data_chunks(data, chunk_size):
+        if isinstance(data, str):
+            kind, data = 'text', data.encode('utf-8')
+        elif hasattr(data, 'read'):
+            kind = 'bytes'
+        elif isinstance(data, (bytes, bytearray, memoryview, mmap.mmap)):
+            kind = 'bytes'
+        else:
+            kind, data = 'json', json.dumps(data).encode('utf-8')
+        if hasattr(data, 'read'):
+            # Size of a file is only known if it can be asked without
+            # reading it, otherwise the page collects the chunks
+            try:
+                size = os.fstat(data.fileno()).st_size - data.tell()
+            except (AttributeError, OSError, ValueError):
+                size = -1
+            chunks = iter(functools.partial(data.read, chunk_size), b'')
+        else:
+            view = memoryview(data).cast('B')
+            size = len(view)
+            chunks = (view[i:i + chunk_size]
+                for i in range(0, size, chunk_size))
+        return kind, size, chunks
+
+    def _send_chunks(self, transfer):
+        # Runs in the data executor, so that reading files and base64
+        # encoding do not block the main thread. Only the evaluations are
+        # done there, at most data_chunks_in_flight at a time.
+        try:
+            for chunk in transfer.chunks:
+                js = (f'pythonista._dataChunk({transfer.id}, "' +
+                    base64.b64encode(chunk).decode('ascii') + '")')
+                if not self._data_window(transfer):
+                    break
+                self._send_data_js(transfer, js)
+            else:
+                if self._data_window(transfer):
+                    self._send_data_js(transfer,
+                        f'pythonista._dataEnd({transfer.id})', last=True)
+                    return
+        except Exception as e:
+            if not transfer.future.done():
+                transfer.future.set_exception(e)
+        self.eval_js_async(f'pythonista._dataAbort({transfer.id})')
+
+    @staticmethod
+    def _data_window(transfer):
+        # Waits for a free slot, False if the transfer has been cancelled
+        # or has failed in the meantime
+        while not transfer.window.acquire(timeout=0.5):
+            if transfer.future.done():
+                return False
+        return not transfer.future.done()
+
+    @on_main_thread
+    def _send_data_js(self, transfer, js, last=False):
+        transfer.in_flight += 1
+        transfer.finished = last
+        self.eval_js_async(js,
+            functools.partial(self._data_sent, transfer),
+            value_format='native')
+
+    def _data_sent(self, transfer, result):
+        transfer.in_flight -= 1
+        transfer.window.release()
+        future = transfer.future
+        if future.done():
+            return
+        if result is not True:
+            future.set_exception(JavascriptError(
+                'Data transfer was interrupted by the page'))
+            return
+        if transfer.finished and transfer.in_flight == 0:
+            future.set_result(None)
+
+    # Bulk data from the page to Python
+
+    js_send_script = '''(function() {
+    var p = window.pythonista;
+    var nextId = 1;
+    var sends = {};
+    function post(message) {
+     window.webkit.messageHandlers._pythonista_data.postMessage(message);
+    }
+    function toBase64(bytes) {
+     var parts = [];
+     for (var i = 0; i < bytes.length; i += 0x8000) {
+      parts.push(String.fromCharCode.apply(
+       null, bytes.subarray(i, i + 0x8000)));
+     }
+     return btoa(parts.join(''));
+    }
+    function readSlice(data, start, end) {
+     if (!(data instanceof Blob)) {
+      return Promise.resolve(data.subarray(start, end));
+     }
+     var slice = data.slice(start, end);
+     if (slice.arrayBuffer) {
+      return slice.arrayBuffer().then(function(buffer) {
+       return new Uint8Array(buffer);
+      });
+     }
+     return new Promise(function(resolve, reject) {
+      var reader = new FileReader();
+      reader.onload = function() { resolve(new Uint8Array(reader.result)); };
+      reader.onerror = function() { reject(reader.error); };
+      reader.readAsArrayBuffer(slice);
+     });
+    }
+    p.send = function(name, data, options) {
+     options = options || {};
+     if (typeof data === 'string') {
+      data = new TextEncoder().encode(data);
+     } else if (data instanceof ArrayBuffer) {
+      data = new Uint8Array(data);
+     } else if (ArrayBuffer.isView(data)) {
+      data = new Uint8Array(data.buffer, data.byteOffset, data.byteLength);
+     }
+     var size = data instanceof Blob ? data.size : data.length;
+     var chunkSize = options.chunkSize || p.sendChunkSize;
+     var id = nextId++;
+     return new Promise(function(resolve, reject) {
+      var send = sends[id] = {
+       size: size, received: 0, wake: null,
+       onProgress: options.onProgress, resolve: resolve, reject: reject};
+      var offset = 0;
+      function next() {
+       if (sends[id] !== send) { return; }
+       if (offset >= size) {
+        post(['end', id]);
+       } else if (offset - send.received >= p.sendMaxInFlight) {
+        send.wake = next;
+       } else {
+        var end = Math.min(offset + chunkSize, size);
+        readSlice(data, offset, end).then(function(bytes) {
+         post(['chunk', id, offset, toBase64(bytes)]);
+         offset = end;
+         next();
+        }, function(error) {
+         delete sends[id];
+         post(['abort', id]);
+         reject(error);
+        });
+       }
+      }
+      post(['begin', id, name, size]);
+      next();
+     });
+    };
+    p._sendAck = function(id, received) {
+     var send = sends[id];
+     if (!send) { return; }
+     send.received = received;
+     if (send.onProgress) { send.onProgress(received, send.size); }
+     var wake = send.wake;
+     send.wake = null;
+     if (wake) { wake(); }
+    };
+    p._sendDone = function(id, error) {
+     var send = sends[id];
+     if (!send) { return; }
+     delete sends[id];
+     if (error) { send.reject(new Error(error)); } else { send.resolve(); }
+    };
+    })();'''
+
+    _data_channel = '_pythonista_data'
+    incoming_chunk_size = 256 * 1024
+    incoming_max_in_flight = 1024 * 1024
+    incoming_max_size = 256 * 1024 * 1024
+
+    def _send_script(self):
+        return (
+            'window.pythonista = window.pythonista || {};\n'
+            f'pythonista.sendChunkSize = {int(self.incoming_chunk_size)};\n'
+            'pythonista.sendMaxInFlight = '
+            f'{int(self.incoming_max_in_flight)};\n' +
+            WKWebView.js_send_script)
+
+    def _receive_data(self, message):
+        # Chunks are decoded straight into a buffer allocated for the whole
+        # transfer, and the handler gets a memoryview of it
+        kind, transfer_id = message[0], message[1]
+        if kind == 'begin':
+            name, size = message[2], message[3]
+            if name not in self._message_handlers:
+                self.eval_js_async(
+                    f'pythonista._sendDone({transfer_id}, ' +
+                    json.dumps(f'No handler for {name}') + ')')
+                raise Exception(
+                    f'Unhandled data from script - name: {name}')
+            # The size comes from the page, so it is checked before the
+            # buffer is allocated
+            if not isinstance(size, int) or \
+                    not 0 <= size <= self.incoming_max_size:
+                self.eval_js_async(
+                    f'pythonista._sendDone({transfer_id}, ' +
+                    json.dumps(f'Data size {size} is not between 0 and '
+                        f'incoming_max_size, {self.incoming_max_size} bytes') + ')')
+                return
+            self._incoming[transfer_id] = SimpleNamespace(
+                name=name, view=memoryview(bytearray(size)), received=0)
+            return
+        transfer = self._incoming.get(transfer_id)
+        if transfer is None:
+            return
+        if kind == 'chunk':
+            offset, chunk = message[2], base64.b64decode(message[3])
+            try:
+                transfer.view[offset:offset + len(chunk)] = chunk
+            except ValueError:
+                del self._incoming[transfer_id]
+                self.eval_js_async(f'pythonista._sendDone({transfer_id}, '
+                    '"Data does not match the announced size")')
+                return
+            transfer.received += len(chunk)
+            self.transfer_progress(
+                transfer.name, transfer.received, len(transfer.view))
+            self.eval_js_async(
+                f'pythonista._sendAck({transfer_id}, {transfer.received})')
+        elif kind == 'end':
+            del self._incoming[transfer_id]
+            self.eval_js_async(f'pythonista._sendDone({transfer_id})')
+            if self._metrics is not None:
+                self._count_messages(transfer.name, [transfer.view])
+            self._message_handlers[transfer.name].deliver([transfer.view])
+            self._publish_message(transfer.name, transfer.view)
+        else:
+            del self._incoming[transfer_id]
+
+    def transfer_progress(self, name, received, total):
+        """ Called on the main thread for every chunk of data received
+        with `pythonista.send`. Override to track the progress of large
+        transfers. """
+
+    # Page lifecycle
+
+    js_dom_script = '''if (window === window.top) {
+    document.addEventListener('DOMContentLoaded', function() {
+     window.webkit.messageHandlers._pythonista_dom.postMessage(null);
+    });
+    }'''
+
+    _dom_channel = '_pythonista_dom'
+
+    # DOM observation
+
+    js_observe_script = '''(function() {
+    var p = window.pythonista;
+    var observations = {};
+    var sent = {};
+    var observer = null;
+    var scheduled = false;
+    function read(element, spec) {
+     var value = {};
+     if (spec.text) { value.text = element.textContent; }
+     if (spec.attributes.length) {
+      value.attributes = {};
+      spec.attributes.forEach(function(name) {
+       value.attributes[name] = element.getAttribute(name);
+      });
+     }
+     return value;
+    }
+    function flush() {
+     if (!scheduled) { return; }
+     scheduled = false;
+     var updates = [];
+     Object.keys(observations).forEach(function(id) {
+      var spec = observations[id];
+      try {
+       var elements = document.querySelectorAll(spec.selector);
+      } catch (e) {
+       // Typically an invalid selector, reported once and dropped so
+       // that the other observations keep working
+       delete observations[id];
+       updates.push([Number(id), -1, String(e)]);
+       return;
+      }
+      // The first check on a page is always sent, so that values left
+      // from the previous page are cleared even if nothing matches here
+      var previous = sent[id] || [];
+      var current = [];
+      var changes = {};
+      var changed = !(id in sent) || elements.length !== previous.length;
+      for (var i = 0; i < elements.length; i++) {
+       var value = read(elements[i], spec);
+       current.push(JSON.stringify(value));
+       if (current[i] !== previous[i]) {
+        changes[i] = value;
+        changed = true;
+       }
+      }
+      if (changed) {
+       sent[id] = current;
+       updates.push([Number(id), elements.length, changes]);
+      }
+     });
+     if (updates.length) {
+      window.webkit.messageHandlers._pythonista_observe.postMessage(
+       JSON.stringify(updates));
+     }
+    }
+    function schedule() {
+     if (scheduled) { return; }
+     scheduled = true;
+     window.requestAnimationFrame(flush);
+     setTimeout(flush, 100);
+    }
+    p._observe = function(id, selector, attributes, text) {
+     observations[id] = {
+      selector: selector, attributes: attributes, text: text};
+     delete sent[id];
+     if (!observer) {
+      observer = new MutationObserver(schedule);
+      observer.observe(document, {
+       subtree: true, childList: true, characterData: true,
+       attributes: true});
+     }
+     schedule();
+    };
+    p._unobserve = function(id) {
+     delete observations[id];
+     delete sent[id];
+    };
+    })();'''
+
+    _observe_channel = '_pythonista_observe'
+
+    def observe(self, selector, callback, attributes=(), text=True):
+        """ Calls `callback(values, changed)` whenever the text content or
+        one of the named `attributes` of the elements matching the CSS
+        `selector` change, in this and later pages.
+
+        `values` has a dict per matching element, in document order, with
+        the `text` and a dict of `attributes`, and `changed` lists the
+        indexes of the values that changed. Changes are collected in the
+        page with a MutationObserver, and only changed values are sent
+        to Python, at most once per animation frame.
+
+        Returns an id for `unobserve`. An observation with an invalid
+        selector is reported as an error and removed. """
+        observer_id = next(self._observer_ids)
+        args = (observer_id, selector, list(attributes), bool(text))
+        self._observers[observer_id] = SimpleNamespace(
+            args=args,
+            values=[],
+            handler=_MessageHandler(
+                lambda update: callback(*update), self.message_executor))
+        self._update_observe_script()
+        self.eval_js_async(self._observe_js(args))
+        return observer_id
+
+    def unobserve(self, observer_id):
+        """ Stops an observation started with `observe`. """
+        if self._observers.pop(observer_id, None) is not None:
+            self._update_observe_script()
+            self.eval_js_async(
+                f'if (window.pythonista) {{ '
+                f'pythonista._unobserve({observer_id}); }}')
+
+    @staticmethod
+    def _observe_js(args):
+        return ('if (window.pythonista) { pythonista._observe(' +
+            ', '.join(json.dumps(arg) for arg in args) + '); }')
+
+    def _update_observe_script(self):
+        self._internal_scripts['observe'] = '\n'.join(
+            [WKWebView.js_observe_script] + [
+                self._observe_js(observer.args)
+                for observer in self._observers.values()])
+        self._install_user_scripts()
+
+    def _dispatch_observed(self, batch):
+        for observer_id, count, changes in json.loads(batch):
+            observer = self._observers.get(observer_id)
+            if observer is None:
+                continue
+            if count < 0:
+                # The observation failed in the page, `changes` is the error
+                del self._observers[observer_id]
+                self._update_observe_script()
+                self._message({'level': 'error', 'content':
+                    f'Observing {observer.args[1]!r} failed: {changes}'})
+                continue
+            if not changes and count == len(observer.values):
+                continue
+            values = observer.values[:count]
+            values.extend([None] * (count - len(values)))
+            for index, value in changes.items():
+                values[int(index)] = value
+            observer.values = values
+            changed = sorted(int(index) for index in changes)
+            observer.handler.deliver([(values, changed)])
+
+    # Calls from the page to Python
+
+    js_call_script = '''(function() {
+    var p = window.pythonista;
+    // Ids are unique per page, so late results for a previous page are
+    // ignored
+    var prefix = Math.random().toString(36).slice(2) + ':';
+    var nextId = 1;
+    var pending = {};
+    var queue = [];
+    var scheduled = false;
+    function flush() {
+     scheduled = false;
+     var batch = queue;
+     queue = [];
+     window.webkit.messageHandlers._pythonista_call.postMessage(
+      JSON.stringify(batch));
+    }
+    p.call = function(name) {
+     var args = Array.prototype.slice.call(arguments, 1);
+     var id = prefix + nextId++;
+     return new Promise(function(resolve, reject) {
+      pending[id] = [resolve, reject];
+      queue.push([id, name, args]);
+      if (!scheduled) {
+       scheduled = true;
+       Promise.resolve().then(flush);
+      }
+     });
+    };
+    p._resolveCalls = function(results) {
+     results.forEach(function(result) {
+      var callbacks = pending[result[0]];
+      if (!callbacks) { return; }
+      delete pending[result[0]];
+      if (result[1]) {
+       callbacks[0](result[2]);
+      } else {
+       var error = new Error(result[2][1]);
+       error.name = result[2][0];
+       callbacks[1](error);
+      }
+     });
+    };
+    })();'''
+
+    _call_channel = '_pythonista_call'
+    _call_executor = _lazy(
+        concurrent.futures.ThreadPoolExecutor, max_workers=4)
+
+    def expose(self, func=None, name=None):
+        """ Makes `func` callable from the page as
+        `await pythonista.call(name, ...args)`, with the function name as
+        the default `name`. Can be used as a decorator, `@view.expose` or
+        `@view.expose(name='other')`.
+
+        Calls run in the `call_executor` given to the constructor, which
+        can be a `concurrent.futures.Executor` or an asyncio event loop, or
+        by default in a shared thread pool. Coroutine functions are awaited
+        in the event loop, or run to completion in the executor thread.
+        Return values are sent back as JSON,
+        and exceptions reject the promise in the page. """
+        if func is None:
+            return functools.partial(self.expose, name=name)
+        self._exposed[name or func.__name__] = func
+        return func
+
+    def unexpose(self, name):
+        """ Removes a function exposed with `expose`. """
+        self._exposed.pop(name, None)
+
+    def _dispatch_calls(self, batch):
+        executor = self.call_executor or WKWebView._call_executor
+        for call_id, name, args in json.loads(batch):
+            func = self._exposed.get(name)
+            if func is None:
+                self._call_finished(call_id, None, LookupError(
+                    f'No Python function exposed as {name}'))
+                continue
+            if isinstance(executor, asyncio.AbstractEventLoop):
+                asyncio.run_coroutine_threadsafe(
+                    self._call_aio(call_id, func, args), executor)
+            else:
+                executor.submit(self._call, call_id, func, args)
+
+    def _call(self, call_id, func, args):
+        try:
+            result = func(*args)
+            if asyncio.iscoroutine(result):
+                # Executor thread, which has no event loop
+                loop = asyncio.new_event_loop()
+                try:
+                    result = loop.run_until_complete(result)
+                finally:
+                    loop.close()
+        except Exception as e:
+            self._call_finished(call_id, None, e)
+        else:
+            self._call_finished(call_id, result)
+
+    async def _call_aio(self, call_id, func, args):
+        try:
+            result = func(*args)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except Exception as e:
+            self._call_finished(call_id, None, e)
+        else:
+            self._call_finished(call_id, result)
+
+    def _call_finished(self, call_id, result, error=None):
+        # Results are serialized here, outside the main thread
+        if error is None:
+            try:
+                result = json.dumps([call_id, True, result])
+            except (TypeError, ValueError) as e:
+                error = e
+        if error is not None:
+            result = json.dumps(
+                [call_id, False, [type(error).__name__, str(error)]])
+        # Results that finish while an earlier flush is pending are sent
+        # to the page together
+        with self._call_lock:
+            self._call_results.append(result)
+            if self._call_flush_scheduled:
+                return
+            self._call_flush_scheduled = True
+        self._flush_call_results()
+
+    @on_main_thread
+    def _flush_call_results(self):
+        with self._call_lock:
+            results, self._call_results = self._call_results, []
+            self._call_flush_scheduled = False
+        self.eval_js_async(
+            'pythonista._resolveCalls([' + ','.join(results) + '])')
+
     def _javascript_alert(self, host, message):
         console.alert(host, message, 'OK', hide_cancel_button=True)
 
@@ -363,33 +2956,101 @@ class WKWebView(ui.View):
         except KeyboardInterrupt:
             return None
 
-    js_logging_script = '''console = new Object();
-    console.info = function(message) { 
-     window.webkit.messageHandlers.javascript_console_message.postMessage(
-      JSON.stringify({ level: "info", content: message})
-     ); return false; };
-    console.log = function(message) { 
-     window.webkit.messageHandlers.javascript_console_message.postMessage(
-      JSON.stringify({ level: "log", content: message})
-     ); return false; };
-    console.warn = function(message) { 
-     window.webkit.messageHandlers.javascript_console_message.postMessage(
-      JSON.stringify({ level: "warn", content: message})
-     ); return false; };
-    console.error = function(message) {
+    js_logging_script = '''(function() {
+    var p = window.pythonista;
+    var levels = ['debug', 'log', 'info', 'warn', 'error'];
+    var minLevel = levels.indexOf(p.consoleLevel);
+    var buffer = [];
+    var scheduled = false;
+    function flush() {
+     scheduled = false;
+     if (buffer.length === 0) { return; }
+     var records = buffer;
+     buffer = [];
      window.webkit.messageHandlers.javascript_console_message.postMessage(
-      JSON.stringify({ level: "error", content: message})
-     ); return false; };
-    window.onerror = (function(error, url, line, col, errorobj) {
-     console.error(
-      "" + error + " (" + url + ", line: " + line + ", column: " + col + ")"
-     );
-    });'''
+      JSON.stringify(records));
+    }
+    function serialize(arg) {
+     if (typeof arg === 'string') { return arg; }
+     if (arg instanceof Error) { return String(arg); }
+     try {
+      var json = JSON.stringify(arg);
+      return json === undefined ? String(arg) : json;
+     } catch (e) {
+      return String(arg);
+     }
+    }
+    function caller() {
+     // Stack frames: caller(), console method, calling code
+     var frame = (new Error().stack || '').split('\\n')[2] || '';
+     return frame.substring(frame.indexOf('@') + 1) || null;
+    }
+    function record(level, args, source) {
+     args = Array.prototype.map.call(args, serialize);
+     buffer.push({
+      level: level, content: args.join(' '), args: args,
+      time: Date.now(), source: source});
+     if (buffer.length > p.consoleBufferSize) { buffer.shift(); }
+     if (!scheduled) {
+      scheduled = true;
+      window.requestAnimationFrame(flush);
+      setTimeout(flush, 100);
+     }
+    }
+    function noop() { return false; }
+    levels.forEach(function(level, index) {
+     console[level] = index < minLevel ? noop : function() {
+      record(level, arguments, caller());
+      return false;
+     };
+    });
+    // 'error' is the highest level, so uncaught errors are always logged
+    window.onerror = function(error, url, line, col, errorobj) {
+     record('error',
+      ["" + error + " (" + url + ", line: " + line + ", column: " + col +
+       ")"],
+      url + ':' + line + ':' + col);
+    };
+    window.addEventListener('pagehide', flush);
+    })();'''
+
+    CONSOLE_LEVELS = ('debug', 'log', 'info', 'warn', 'error')
+
+    def _logging_script(self, level, buffer_size):
+        return (
+            f'pythonista.consoleLevel = {json.dumps(level)};\n'
+            f'pythonista.consoleBufferSize = {int(buffer_size)};\n' +
+            WKWebView.js_logging_script)
 
     def on_javascript_console_message(self, message):
-        log_message = json.loads(message)
-        #self.console.message(log_message)
-        self._message(log_message)
+        records = json.loads(message) if isinstance(message, str) \
+            else message
+        if isinstance(records, dict):
+            records = [records]
+        for record in records:
+            record['time'] = record.get('time', time.time() * 1000) / 1000
+            self._console_log.append(record)
+            self._message(record)
+
+    def get_console_log(self, since=None, level=None):
+        """ Returns the javascript console messages collected so far, oldest
+        first, as dicts with the following keys:
+
+          * `level` - 'debug', 'log', 'info', 'warn' or 'error'
+          * `content` - the console call arguments joined into a string
+          * `args` - the arguments, serialized into strings one by one
+          * `time` - timestamp in seconds, comparable with `time.time()`
+          * `source` - `url:line:column` of the console call, if available
+
+        Optionally only returns messages logged after the `since` timestamp,
+        and/or messages with at least the given `level`.
+        """
+        min_level = WKWebView.CONSOLE_LEVELS.index(level) if level else 0
+        return [
+            record for record in list(self._console_log)
+            if (since is None or record['time'] > since)
+            and WKWebView.CONSOLE_LEVELS.index(record['level']) >= min_level
+        ]
 
     def _message(self, message):
         level, content = message['level'], message['content']
@@ -439,8 +3100,18 @@ class WKWebView(ui.View):
             return string
 
     @classmethod
-    def console(self, webview_index=0):
-        webview = WKWebView.webviews[webview_index]
+    def console(self, webview_index=None):
+        # Indexes are the ones shown by `list`, by default the oldest view
+        # that is not closed
+        indexes = list(WKWebView._open_webviews().keys())
+        if not indexes:
+            raise RuntimeError('No WKWebViews to evaluate javascript in')
+        if webview_index is None:
+            webview_index = min(indexes)
+        webview = WKWebView._open_webviews().get(webview_index)
+        if webview is None:
+            raise ValueError(f'No WKWebView with index {webview_index}, '
+                f'available: {sorted(indexes)}')
         theme = WKWebView.Theme.get_theme()
 
         print('Welcome to WKWebView console.')
@@ -453,12 +3124,15 @@ class WKWebView(ui.View):
             if value == 'quit':
                 break
             if value == 'list':
-                for i in range(len(WKWebView.webviews)):
-                    wv = WKWebView.webviews[i]
+                for i, wv in WKWebView._open_webviews().items():
                     print(i, '-', wv.name, '-', wv.eval_js('document.title'))
             elif value.startswith('switch '):
                 i = int(value[len('switch '):])
-                webview = WKWebView.webviews[i]
+                selected = WKWebView._open_webviews().get(i)
+                if selected is None:
+                    print('No WKWebView with index', i)
+                else:
+                    webview = selected
             elif value.startswith('load '):
                 url = value[len('load '):]
                 webview.load_url(url)
@@ -469,14 +3143,30 @@ class WKWebView(ui.View):
 
     # MAIN OBJC SECTION
 
-    WKWebView = ObjCClass('WKWebView')
-    UIViewController = ObjCClass('UIViewController')
-    WKWebViewConfiguration = ObjCClass('WKWebViewConfiguration')
-    WKUserContentController = ObjCClass('WKUserContentController')
-    NSURLRequest = ObjCClass('NSURLRequest')
-    WKUserScript = ObjCClass('WKUserScript')
-    WKWebsiteDataStore = ObjCClass('WKWebsiteDataStore')
-    NSDate = ObjCClass('NSDate')
+    WKWebView = _lazy(ObjCClass, 'WKWebView')
+    UIViewController = _lazy(ObjCClass, 'UIViewController')
+    WKWebViewConfiguration = _lazy(ObjCClass, 'WKWebViewConfiguration')
+    WKUserContentController = _lazy(ObjCClass, 'WKUserContentController')
+    NSURLRequest = _lazy(ObjCClass, 'NSURLRequest')
+    WKUserScript = _lazy(ObjCClass, 'WKUserScript')
+    WKWebsiteDataStore = _lazy(ObjCClass, 'WKWebsiteDataStore')
+    WKProcessPool = _lazy(ObjCClass, 'WKProcessPool')
+    NSHTTPURLResponse = _lazy(ObjCClass, 'NSHTTPURLResponse')
+    WKContentRuleListStore = _lazy(ObjCClass, 'WKContentRuleListStore')
+    WKSnapshotConfiguration = _lazy(ObjCClass, 'WKSnapshotConfiguration')
+    NSDate = _lazy(ObjCClass, 'NSDate')
+    NSError = _lazy(ObjCClass, 'NSError')
+    NSSet = _lazy(ObjCClass, 'NSSet')
+    NSHTTPCookie = _lazy(ObjCClass, 'NSHTTPCookie')
+    NSString = _lazy(ObjCClass, 'NSString')
+    NSNumber = _lazy(ObjCClass, 'NSNumber')
+    NSArray = _lazy(ObjCClass, 'NSArray')
+    NSDictionary = _lazy(ObjCClass, 'NSDictionary')
+    NSNull = _lazy(ObjCClass, 'NSNull')
+    NSData = _lazy(ObjCClass, 'NSData')
+
+    # One WebContent process pool shared by all views
+    shared_process_pool = _lazy(lambda: WKWebView.WKProcessPool.new())
 
     # Navigation delegate
 
@@ -485,29 +3175,39 @@ class WKWebView(ui.View):
 
     def webView_decidePolicyForNavigationAction_decisionHandler_(
             _self, _cmd, _webview, _navigation_action, _decision_handler):
-        delegate_instance = ObjCInstance(_self)
-        webview = delegate_instance._pythonistawebview()
-        deleg = webview.delegate
+        webview = _delegate_views[_self]
+        started = time.perf_counter() \
+            if webview._metrics is not None else None
         nav_action = ObjCInstance(_navigation_action)
         ns_url = nav_action.request().URL()
-        url = str(ns_url)
-        nav_type = int(nav_action.navigationType())
-
-        allow = True
-        if deleg is not None:
-            if hasattr(deleg, 'webview_should_start_load'):
-                allow = deleg.webview_should_start_load(webview, url, nav_type)
-
-        scheme = str(ns_url.scheme())
-        if not WKWebView.WKWebView.handlesURLScheme_(scheme):
+        # Only converted when needed, this runs for every frame and redirect
+        url = None
+
+        rules = webview._navigation_rules
+        ruling = None
+        if rules is not None:
+            url = str(ns_url)
+            ruling = rules.decide(url)
+        allow = True if ruling is None else ruling
+        should_start_load = webview._delegate_methods[0]
+        if ruling is None and should_start_load is not None:
+            if url is None:
+                url = str(ns_url)
+            allow = should_start_load(
+                webview, url, int(nav_action.navigationType()))
+
+        if ruling is not False and \
+                not webview._handles_scheme(str(ns_url.scheme())):
             allow = False
-            webbrowser.open(url)
+            webbrowser.open(str(ns_url) if url is None else url)
 
         allow_or_cancel = 1 if allow else 0
-        decision_handler = ObjCInstance(_decision_handler)
-        retain_global(decision_handler)
+        token = _retained.retain(ObjCInstance(_decision_handler))
         blk = WKWebView._block_decision_handler.from_address(_decision_handler)
         blk.invoke(_decision_handler, allow_or_cancel)
+        _retained.release(token)
+        if started is not None:
+            webview._navigation_decided(nav_action, started)
 
     f = webView_decidePolicyForNavigationAction_decisionHandler_
     f.argtypes = [c_void_p]*3
@@ -516,43 +3216,50 @@ class WKWebView(ui.View):
     # https://developer.apple.com/library/archive/documentation/Cocoa/Conceptual/ObjCRuntimeGuide/Articles/ocrtTypeEncodings.html
 
     def webView_didCommitNavigation_(_self, _cmd, _webview, _navigation):
-        delegate_instance = ObjCInstance(_self)
-        webview = delegate_instance._pythonistawebview()
-        deleg = webview.delegate
-        if deleg is not None:
-            if hasattr(deleg, 'webview_did_start_load'):
-                deleg.webview_did_start_load(webview)
+        webview = _delegate_views[_self]
+        webview._committed_navigation = _objc_key(_navigation)
+        webview.clear_eval_js_cache()
+        # Transfers from the previous page will not be finished
+        webview._incoming.clear()
+        if webview._metrics is not None:
+            webview._navigation_committed(_navigation)
+        did_start_load = webview._delegate_methods[1]
+        if did_start_load is not None:
+            did_start_load(webview)
 
     def webView_didFinishNavigation_(_self, _cmd, _webview, _navigation):
-        delegate_instance = ObjCInstance(_self)
-        webview = delegate_instance._pythonistawebview()
-        deleg = webview.delegate
-        if deleg is not None:
-            if hasattr(deleg, 'webview_did_finish_load'):
-                deleg.webview_did_finish_load(webview)
+        webview = _delegate_views[_self]
+        webview._navigation_finished(_navigation)
+        if webview._metrics is not None:
+            webview._navigation_done(_navigation)
+        did_finish_load = webview._delegate_methods[2]
+        if did_finish_load is not None:
+            did_finish_load(webview)
 
     def webView_didFailNavigation_withError_(
             _self, _cmd, _webview, _navigation, _error):
 
-        delegate_instance = ObjCInstance(_self)
-        webview = delegate_instance._pythonistawebview()
-        deleg = webview.delegate
+        webview = _delegate_views[_self]
         err = ObjCInstance(_error)
         error_code = int(err.code())
         error_msg = str(err.localizedDescription())
-        if deleg is not None:
-            if hasattr(deleg, 'webview_did_fail_load'):
-                deleg.webview_did_fail_load(webview, error_code, error_msg)
-                return
-        raise RuntimeError(
-            f'WKWebView load failed with code {error_code}: {error_msg}')
+        error = NavigationError(error_code, error_msg)
+        awaited = webview._navigation_finished(_navigation, error)
+        if webview._metrics is not None:
+            webview._navigation_done(_navigation, failed=True)
+        did_fail_load = webview._delegate_methods[3]
+        if did_fail_load is not None:
+            did_fail_load(webview, error_code, error_msg)
+            return
+        if not awaited:
+            raise error
 
     def webView_didFailProvisionalNavigation_withError_(
             _self, _cmd, _webview, _navigation, _error):
         WKWebView.webView_didFailNavigation_withError_(
             _self, _cmd, _webview, _navigation, _error)
 
-    CustomNavigationDelegate = create_objc_class(
+    CustomNavigationDelegate = _lazy(create_objc_class,
         'CustomNavigationDelegate', superclass=NSObject, methods=[
             webView_didCommitNavigation_,
             webView_didFinishNavigation_,
@@ -566,24 +3273,50 @@ class WKWebView(ui.View):
 
     def userContentController_didReceiveScriptMessage_(
             _self, _cmd, _userContentController, _message):
-        controller_instance = ObjCInstance(_self)
-        webview = controller_instance._pythonistawebview()
+        webview = _delegate_views[_self]
         wk_message = ObjCInstance(_message)
         name = str(wk_message.name())
-        content = str(wk_message.body())
-        handler = getattr(webview, 'on_'+name, None)
-        if handler:
-            handler(content)
-        else:
-            raise Exception(
-                f'Unhandled message from script - name: {name}, '
-                'content: {content}')
-
-    CustomMessageHandler = create_objc_class(
-        'CustomMessageHandler', UIViewController, methods=[
-            userContentController_didReceiveScriptMessage_
-        ], protocols=['WKScriptMessageHandler'])
-
+        if name == WKWebView._batch_channel:
+            webview._dispatch_batch(str(wk_message.body()))
+            return
+        if name == WKWebView._data_channel:
+            webview._receive_data(objc_to_python(wk_message.body()))
+            return
+        if name == WKWebView._call_channel:
+            webview._dispatch_calls(str(wk_message.body()))
+            return
+        if name == WKWebView._dom_channel:
+            webview._dom_ready()
+            return
+        if name == WKWebView._observe_channel:
+            webview._dispatch_observed(str(wk_message.body()))
+            return
+        content = WKWebView._convert_value(
+            wk_message.body(), webview.value_format)
+        webview._dispatch_message(name, content)
+
+    CustomMessageHandler = _lazy(lambda: create_objc_class(
+        'CustomMessageHandler', WKWebView.UIViewController, methods=[
+            WKWebView.userContentController_didReceiveScriptMessage_
+        ], protocols=['WKScriptMessageHandler']))
+
+
+    # Custom url scheme handler
+
+    def webView_startURLSchemeTask_(_self, _cmd, _webview, _task):
+        webview = _delegate_views[_self]
+        webview._start_scheme_task(ObjCInstance(_task))
+
+    def webView_stopURLSchemeTask_(_self, _cmd, _webview, _task):
+        webview = _delegate_views[_self]
+        webview._stop_scheme_task(ObjCInstance(_task))
+
+    CustomURLSchemeHandler = _lazy(create_objc_class,
+        'CustomURLSchemeHandler', superclass=NSObject, methods=[
+            webView_startURLSchemeTask_,
+            webView_stopURLSchemeTask_
+        ],
+        protocols=['WKURLSchemeHandler'])
 
     # UI delegate (for alerts etc.)
 
@@ -592,17 +3325,16 @@ class WKWebView(ui.View):
 
     def webView_runJavaScriptAlertPanelWithMessage_initiatedByFrame_completionHandler_(
             _self, _cmd, _webview, _message, _frame, _completion_handler):
-        delegate_instance = ObjCInstance(_self)
-        webview = delegate_instance._pythonistawebview()
+        webview = _delegate_views[_self]
         message = str(ObjCInstance(_message))
         host = str(ObjCInstance(_frame).request().URL().host())
         webview._javascript_alert(host, message)
         #console.alert(host, message, 'OK', hide_cancel_button=True)
-        completion_handler = ObjCInstance(_completion_handler)
-        retain_global(completion_handler)
+        token = _retained.retain(ObjCInstance(_completion_handler))
         blk = WKWebView._block_alert_completion.from_address(
             _completion_handler)
         blk.invoke(_completion_handler)
+        _retained.release(token)
 
     f = webView_runJavaScriptAlertPanelWithMessage_initiatedByFrame_completionHandler_
     f.argtypes = [c_void_p]*4
@@ -615,15 +3347,14 @@ class WKWebView(ui.View):
 
     def webView_runJavaScriptConfirmPanelWithMessage_initiatedByFrame_completionHandler_(
             _self, _cmd, _webview, _message, _frame, _completion_handler):
-        delegate_instance = ObjCInstance(_self)
-        webview = delegate_instance._pythonistawebview()
+        webview = _delegate_views[_self]
         message = str(ObjCInstance(_message))
         host = str(ObjCInstance(_frame).request().URL().host())
         result = webview._javascript_confirm(host, message)
-        completion_handler = ObjCInstance(_completion_handler)
-        retain_global(completion_handler)
+        token = _retained.retain(ObjCInstance(_completion_handler))
         blk = WKWebView._block_confirm_completion.from_address(_completion_handler)
         blk.invoke(_completion_handler, result)
+        _retained.release(token)
 
     f = webView_runJavaScriptConfirmPanelWithMessage_initiatedByFrame_completionHandler_
     f.argtypes = [c_void_p]*4
@@ -637,24 +3368,23 @@ class WKWebView(ui.View):
     def webView_runJavaScriptTextInputPanelWithPrompt_defaultText_initiatedByFrame_completionHandler_(
             _self, _cmd, _webview, _prompt, _default_text, _frame,
             _completion_handler):
-        delegate_instance = ObjCInstance(_self)
-        webview = delegate_instance._pythonistawebview()
+        webview = _delegate_views[_self]
         prompt = str(ObjCInstance(_prompt))
         default_text = str(ObjCInstance(_default_text))
         host = str(ObjCInstance(_frame).request().URL().host())
         result = webview._javascript_prompt(host, prompt, default_text)
-        completion_handler = ObjCInstance(_completion_handler)
-        retain_global(completion_handler)
+        token = _retained.retain(ObjCInstance(_completion_handler))
         blk = WKWebView._block_text_completion.from_address(
             _completion_handler)
         blk.invoke(_completion_handler, ns(result))
+        _retained.release(token)
 
     f = webView_runJavaScriptTextInputPanelWithPrompt_defaultText_initiatedByFrame_completionHandler_
     f.argtypes = [c_void_p]*5
     f.restype = None
     f.encoding = b'v@:@@@@@?'
 
-    CustomUIDelegate = create_objc_class(
+    CustomUIDelegate = _lazy(create_objc_class,
         'CustomUIDelegate', superclass=NSObject, methods=[
             webView_runJavaScriptAlertPanelWithMessage_initiatedByFrame_completionHandler_,
             webView_runJavaScriptConfirmPanelWithMessage_initiatedByFrame_completionHandler_,
@@ -663,6 +3393,102 @@ class WKWebView(ui.View):
         protocols=['WKUIDelegate'])
 
 
+class WKWebViewPool:
+    """ Keeps a number of created and prewarmed WKWebViews ready for use, to
+    avoid the cold start latency of creating a view and its WebContent
+    process.
+
+    Views are created in a background thread with the given WKWebView
+    (sub)class and constructor keyword arguments. A view taken with
+    `acquire` is reset and returned to the pool when it is closed, or when
+    passed to `release`.
+    """
+
+    def __init__(self, size=2, view_class=WKWebView, **kwargs):
+        self.size = size
+        self.view_class = view_class
+        self.kwargs = kwargs
+        self.hits = 0
+        self.misses = 0
+        self._views = collections.deque()
+        self._lock = threading.Lock()
+        self._filling = False
+        self.fill()
+
+    def fill(self):
+        """ Starts creating views in the background until the pool is
+        full. """
+        with self._lock:
+            if self._filling or len(self._views) >= self.size:
+                return
+            self._filling = True
+        threading.Thread(target=self._fill, daemon=True).start()
+
+    def _fill(self):
+        try:
+            while True:
+                with self._lock:
+                    if len(self._views) >= self.size:
+                        self._filling = False
+                        return
+                view = self._create()
+                with self._lock:
+                    self._views.append(view)
+        except Exception:
+            with self._lock:
+                self._filling = False
+            raise
+
+    def _create(self):
+        view = self.view_class(**self.kwargs)
+        # Loading a blank page starts the WebContent process
+        view.load_html('')
+        return view
+
+    def acquire(self, **attributes):
+        """ Returns a view from the pool, or a new one if the pool is empty.
+        Given keyword arguments are set as attributes of the view, e.g.
+        `frame` or `name`. """
+        with self._lock:
+            view = self._views.popleft() if self._views else None
+            if view is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if view is None:
+            view = self._create()
+        view._pool = self
+        for name, value in attributes.items():
+            setattr(view, name, value)
+        self.fill()
+        return view
+
+    def release(self, view):
+        """ Resets the view and returns it to the pool, or discards it if
+        the pool is already full. """
+        view._pool = None
+        if view.closed:
+            return
+        view._reset_for_reuse()
+        with self._lock:
+            if len(self._views) < self.size:
+                self._views.append(view)
+                return
+        # No longer pooled, so this releases what the view holds in WebKit
+        view.close()
+
+    def stats(self):
+        """ Returns a dict with the pool `size`, number of `available`
+        views, and the `hits` and `misses` of `acquire`. """
+        with self._lock:
+            return {
+                'size': self.size,
+                'available': len(self._views),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
 if __name__ == '__main__':
 
     class MyWebViewDelegate: